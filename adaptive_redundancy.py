@@ -0,0 +1,142 @@
+from collections import Counter
+import threading
+import xmltodict
+from botocore.exceptions import ClientError
+
+
+def parse_answer(assignment):
+    """
+    :param assignment a boto3 assignment dict
+    :return dict of QuestionIdentifier -> FreeText answer
+    """
+    answers = xmltodict.parse(assignment['Answer'])['QuestionFormAnswers']['Answer']
+    if isinstance(answers, dict):
+        answers = [answers]
+    return {answer['QuestionIdentifier']: answer.get('FreeText') for answer in answers}
+
+
+def default_answer_key(assignment):
+    return tuple(sorted(parse_answer(assignment).items()))
+
+
+class AdaptiveRedundancy:
+    """
+    creates HITs with a small number of assignments and only asks for more on HITs whose workers
+    disagree, up to max_assignments. review_hit can be called from a polling loop over reviewable HITs
+    or registered as a NotificationConsumer handler via handle_event.
+    """
+
+    def __init__(self, mturk, initial_assignments=2, max_assignments=5, step=1, min_agreement=0.6, min_votes=2,
+                 answer_key=default_answer_key):
+        """
+        :param mturk an MTurk instance
+        :param initial_assignments MaxAssignments the HITs are created with
+        :param max_assignments cap on assignments per HIT after extensions
+        :param step assignments added each time a HIT is extended
+        :param min_agreement fraction of assignments that must share the most common answer
+        :param min_votes number of assignments that must share the most common answer
+        :param answer_key callable reducing an assignment to a hashable answer to compare on
+        """
+        if initial_assignments < 10 <= max_assignments:
+            # mturk won't extend a HIT created with fewer than 10 assignments to 10 or more
+            raise ValueError('max_assignments must be below 10 when initial_assignments is')
+        self.mturk = mturk
+        self.initial_assignments = initial_assignments
+        self.max_assignments = max_assignments
+        self.step = step
+        self.min_agreement = min_agreement
+        self.min_votes = min_votes
+        self.answer_key = answer_key
+        self.requested = {}
+        self._lock = threading.Lock()
+
+    def create_hit_group(self, data, task_param_generator, **kwargs):
+        """
+        same as MTurk.create_hit_group, with MaxAssignments lowered to initial_assignments
+        """
+        basic_hit_params = dict(kwargs['basic_hit_params'])
+        full_cost = len(data) * float(basic_hit_params['Reward']) * self.max_assignments * 1.2
+        print(f'Every HIT extended to {self.max_assignments} assignments would cost ${full_cost:.{2}f}')
+        basic_hit_params['MaxAssignments'] = self.initial_assignments
+        kwargs['basic_hit_params'] = basic_hit_params
+        return self.mturk.create_hit_group(data, task_param_generator, **kwargs)
+
+    def agreement(self, assignments):
+        """
+        :return (number of votes for the most common answer, fraction of assignments giving it)
+        """
+        if not assignments:
+            return 0, 0.
+        votes = Counter(self.answer_key(assignment) for assignment in assignments)
+        top_votes = votes.most_common(1)[0][1]
+        return top_votes, top_votes / len(assignments)
+
+    def _requested_assignments(self, hit_id):
+        with self._lock:
+            if hit_id in self.requested:
+                return self.requested[hit_id]
+        hit = self.mturk.amt.client.get_hit(HITId=hit_id)['HIT']
+        with self._lock:
+            return self.requested.setdefault(hit_id, hit['MaxAssignments'])
+
+    def review_hit(self, hit_id, assignments=None):
+        """
+        extends the HIT if all its requested assignments are in and they disagree. rejected assignments
+        use up a requested slot without being republished, so they count towards the assignments that are
+        in but not towards agreement, and extensions add them back on top of max_assignments
+        :param hit_id the HIT to review
+        :param assignments its submitted/approved/rejected assignments, fetched if not given
+        :return one of 'pending', 'agreed', 'capped', 'extended'
+        """
+        if assignments is None:
+            assignments = self.mturk.amt.client.list_assignments_for_hit(
+                HITId=hit_id,
+                AssignmentStatuses=['Submitted', 'Approved', 'Rejected'],
+                MaxResults=100)['Assignments']
+        requested = self._requested_assignments(hit_id)
+        if len(assignments) < requested:
+            return 'pending'
+        accepted = [assignment for assignment in assignments if assignment.get('AssignmentStatus') != 'Rejected']
+        top_votes, agreement = self.agreement(accepted)
+        if top_votes >= self.min_votes and agreement >= self.min_agreement:
+            return 'agreed'
+        n_rejected = len(assignments) - len(accepted)
+        n_additional = min(self.step, self.max_assignments + n_rejected - requested)
+        if requested < 10 <= requested + n_additional:
+            # mturk won't extend a HIT created with fewer than 10 assignments to 10 or more
+            n_additional = 9 - requested
+        if n_additional <= 0:
+            return 'capped'
+        try:
+            self.mturk.amt.client.create_additional_assignments_for_hit(
+                HITId=hit_id,
+                NumberOfAdditionalAssignments=n_additional,
+                UniqueRequestToken=f'{hit_id}-{requested + n_additional}')
+        except ClientError as e:
+            print(e)
+            # the cached count may be stale (e.g. the HIT was extended elsewhere), re-read it next time
+            with self._lock:
+                self.requested.pop(hit_id, None)
+            return 'pending'
+        with self._lock:
+            self.requested[hit_id] = requested + n_additional
+        return 'extended'
+
+    def review(self, hits):
+        """
+        :param hits HIT dicts, e.g. from the reviewable HIT queries
+        :return Counter of review outcomes
+        """
+        outcomes = Counter()
+        for hit in hits:
+            if 'MaxAssignments' in hit:
+                with self._lock:
+                    self.requested[hit['HITId']] = max(self.requested.get(hit['HITId'], 0), hit['MaxAssignments'])
+            outcomes[self.review_hit(hit['HITId'])] += 1
+        return outcomes
+
+    def handle_event(self, event):
+        """
+        NotificationConsumer handler for AssignmentSubmitted / HITReviewable events
+        """
+        self.review_hit(event['HITId'])
@@ -1,14 +1,16 @@
 import pickle
 from collections import defaultdict
-from jinja2 import Environment, FileSystemLoader
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from nltk.tokenize import sent_tokenize
 import PIL.Image as Image
 import requests
 
 
 from boto.mturk.qualification import PercentAssignmentsApprovedRequirement, Qualifications, Requirement, LocaleRequirement
+from mturk import get_template
 
 
 def create_result(assmt):
@@ -38,67 +40,29 @@ def write_task_page(page_html):
 
 
 def generate_task_page(s3_base_path, img_id, template_file='character_bbox.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    page_html = template.render(s3_uri_base=s3_base_path, image_id=img_id)
-    return page_html
+    return STAGES['character_bbox'].render({'stills': s3_base_path}, img_id, template_file=template_file)[0]
 
 
 def generate_simpler_task_page(s3_base_path, img_id, n_chars, template_file='character_bbox_simple.html'):
-    pages = []
-    for char_idx in range(n_chars):
-        env = Environment(loader=FileSystemLoader('hit_templates'))
-        template = env.get_template(template_file)
-        char_img = img_id.rsplit('_', 1)[0] + '_char_' + str(char_idx) + '_taskb.png'
-        page_html = template.render(s3_uri_base=s3_base_path, image_id=img_id, char_img=char_img)
-        page_html = page_html
-        pages.append(page_html)
-    return pages
+    return STAGES['character_bbox_simple'].render({'stills': s3_base_path}, (img_id, n_chars),
+                                                  template_file=template_file)
 
 
 def generate_stage_4a_task_page(img_id, formatted_description, template_file='stage_4a.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    page_html = template.render(image_id=img_id, formatted_description=formatted_description)
-    page_html = page_html
-    return page_html
-
-
-def generate_stage_4b_task_page(img_id, formatted_description, target, template_file='stage_4b.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    page_html = template.render(s3_uri_base=s3_subtask_path, image_id=img_id, description=formatted_description, target_object=target)
-    return page_html
+    return STAGES['stage_4a'].render({}, (img_id, formatted_description), template_file=template_file)[0]
 
 
 def generate_segm_anno_task_page(ent, s3_base, template_file='img_seg.html'):
-    img_id = ent.gid() + '_bb.png'
-    ent_label = ent.data()['entityLabel']
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    page_html = template.render(base_url=s3_base, image_name=img_id, entity_label=ent_label)
-    return page_html
+    return STAGES['segm_anno'].render_entity({'segm': s3_base}, None, ent, template_file=template_file)
 
 
 def generate_stage_4_task_page(s3_base_path, img_id, n_chars, template_file='stage_4.html'):
-    pages = []
-    for char_idx in range(n_chars):
-        env = Environment(loader=FileSystemLoader('hit_templates'))
-        template = env.get_template(template_file)
-        char_img = img_id.rsplit('_', 1)[0] + '_char_' + str(char_idx) + '_taskb.png'
-        page_html = template.render(s3_uri_base=s3_base_path, image_id=img_id, char_img=char_img)
-        page_html = page_html
-        pages.append(page_html)
-    return pages
+    return STAGES['stage_4'].render({'stills': s3_base_path}, (img_id, n_chars), template_file=template_file)
 
 
 def generate_simpler_supl_task_page(s3_base_path, img_id, char_id, template_file='character_bbox_simple.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    char_img = char_id
-    img_id = img_id + '_taskb.png'
-    page_html = template.render(s3_uri_base=s3_base_path, image_id=img_id, char_img=char_img)
-    return page_html
+    return STAGES['character_bbox_supl'].render({'stills': s3_base_path}, (img_id, char_id),
+                                                template_file=template_file)[0]
 
 
 def filter_hits_by_date(hit_group, start_date, end_date):
@@ -108,12 +72,17 @@ def filter_hits_by_date(hit_group, start_date, end_date):
 
     start_datetime = datetime.datetime(*start_date).replace(tzinfo=pytz.UTC)
     end_datetime = datetime.datetime(*end_date).replace(tzinfo=pytz.UTC)
+    if hasattr(hit_group, 'query'):
+        return hit_group.created_between(start_datetime, end_datetime)
     return [hit for hit in hit_group if start_datetime < dt_parse.parse(hit.CreationTime) < end_datetime]
 
 
 def filter_hits_by_date_old(hit_group, day_of_month, hour=None):
     import dateutil.parser as dt_parse
 
+    if hasattr(hit_group, 'query'):
+        return hit_group.created_on(day_of_month, hour if hour else None)
+
     def check_day(hit, day_of_month):
         return day_of_month == dt_parse.parse(hit.CreationTime).day
 
@@ -127,10 +96,14 @@ def filter_hits_by_date_old(hit_group, day_of_month, hour=None):
 
 
 def filter_hits_by_completion(hit_group, n_assigments=3):
+    if hasattr(hit_group, 'query'):
+        return hit_group.with_completion(n_assigments)
     return [hit for hit in hit_group if int(hit.NumberOfAssignmentsCompleted) == n_assigments]
 
 
 def filter_hits_by_status(hit_group, status='Reviewable'):
+    if hasattr(hit_group, 'query'):
+        return hit_group.with_status(status)
     return [hit for hit in hit_group if hit.HITStatus == status]
 
 
@@ -168,12 +141,27 @@ def get_assignments(mturk_connection, reviewable_hits, status=None):
     return assignments
 
 
-def build_hit_params(qhtml, static_params):
+class StaticHitParams(dict):
     """
-    Dynamically builds some HIT params that will change based on the book/url
-    :param url: formatted url of page image on s3
+    static HIT params with the qualifications and reward objects already built, shared by every HIT of a batch.
+    read-only, since every HIT's params are copied from the same instance; copy with dict() to change them
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('StaticHitParams is read-only, copy it with dict() to change it')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    update = setdefault = pop = popitem = clear = _read_only
+
+    def __reduce__(self):
+        return StaticHitParams, (dict(self),)
+
+
+def prepare_static_params(static_params):
+    """
+    Builds the batch-wide part of the HIT params once, so build_hit_params only has to add the page html.
     :param static_params: Universal HIT params (set by user in notebook).
-    :return: complete HIT parameters.
+    :return: StaticHitParams, returned unchanged if already prepared.
     """
     import copy
     import boto
@@ -192,17 +180,31 @@ def build_hit_params(qhtml, static_params):
             requirements.append(loc_req)
         _ = [qualifications.add(req) for req in requirements]
         return qualifications
+    if isinstance(static_params, StaticHitParams):
+        return static_params
     if 'locales' not in static_params:
         static_params['locales'] = None
-    hit_params = copy.deepcopy(static_params)
-    hit_params['qualifications'] = build_qualifications(static_params['locales'])
-    hit_params['reward'] = boto.mturk.price.Price(hit_params['amount'])
+    prepared = copy.deepcopy(static_params)
+    prepared['qualifications'] = build_qualifications(static_params['locales'])
+    prepared['reward'] = boto.mturk.price.Price(prepared['amount'])
+    return StaticHitParams(prepared)
+
+
+def build_hit_params(qhtml, static_params):
+    """
+    Dynamically builds some HIT params that will change based on the book/url
+    :param qhtml: rendered page html
+    :param static_params: Universal HIT params (set by user in notebook), ideally from prepare_static_params.
+    :return: complete HIT parameters.
+    """
+    hit_params = dict(prepare_static_params(static_params))
     hit_params['html'] = qhtml
     return hit_params
 
 
 def prepare_simpler_hit(s3_base_path, still_id, n_chars, static_parameters):
     question_html = generate_simpler_task_page(s3_base_path, still_id, n_chars)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_html]
 
 
@@ -212,8 +214,8 @@ def prepare_simpler_supl_hit(s3_base_path, still_id, char_id, static_parameters)
 
 
 def prepare_stage_1b(s3_base_path, vid, static_parameters):
-    still_id = vid.gid()
-    question_htmls = [generate_simpler_supl_task_page(s3_base_path, still_id, char.gid()) for char in vid.data()['characters']]
+    question_htmls = STAGES['stage_1b'].render({'stills': s3_base_path}, vid)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_htmls]
 
 
@@ -223,87 +225,35 @@ def prepare_hit(s3_base_path, img_uri, static_parameters, task_generator=generat
 
 
 def generate_stage_2_task_page(s3_base_paths, vid_anno, poses, position_prepositions, template_file='stage_2a.html'):
-    pages = []
-    for char in vid_anno['characters']:
-        env = Environment(loader=FileSystemLoader('hit_templates'))
-        template = env.get_template(template_file)
-        image_url = s3_base_paths['stills'] + vid_anno['keyFrames'][0].replace('_40.png', '_10.png')
-        char_url = s3_base_paths['subtask'] + char['imageID']
-        page_html = template.render(s3_uri_base=s3_base_path, image_url=image_url, char_img=char_url, pose_select=poses,
-                                    position_select=position_prepositions)
-        page_html = page_html
-        pages.append(page_html)
-    return pages
+    return STAGES['stage_2a'].render(s3_base_paths, vid_anno, template_file=template_file, poses=poses,
+                                     position_prepositions=position_prepositions)
 
 
 def generate_stage_2b_task_page(s3_base_paths, vid_anno, template_file='stage_2b.html'):
-    pages = []
-    for char in vid_anno['characters']:
-        env = Environment(loader=FileSystemLoader('hit_templates'))
-        template = env.get_template(template_file)
-        image_url = s3_base_paths['gifs'] + vid_anno['globalID'] + '.gif'
-        char_url = s3_base_paths['subtask'] + char['imageID']
-        page_html = template.render(s3_uri_base=s3_base_path, image_url=image_url, char_img=char_url)
-        page_html = page_html
-        pages.append(page_html)
-    return pages
+    return STAGES['stage_2b'].render(s3_base_paths, vid_anno, template_file=template_file)
 
 
 def generate_stage_3b_task_page(s3_base_paths, vid_anno, template_file='stage_3b.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    vid_setting = vid_anno.setting()
-    image_url = s3_base_paths['gifs'] + vid_anno.gid() + '.gif'
-    char_tuples = []
-    strings_to_match = []
-    for char in vid_anno.data()['characters']:
-        char_name = char.data()['entityLabel']
-        strings_to_match.append(char_name)
-        char_url = s3_base_paths['subtask'] + char.gid() + '_taskb.png'
-        char_tuples.append((char_url, char_name))
-    strings_to_match.append(vid_setting)
-    strings_to_match = 'string_join_token'.join(strings_to_match)
-    page_html = template.render(s3_uri_base=s3_base_path, image_url=image_url, char_images=char_tuples,
-                                setting=vid_setting, strings_to_match=strings_to_match)
-    return page_html
+    return STAGES['stage_3b'].render(s3_base_paths, vid_anno, template_file=template_file)[0]
 
 
 def generate_baseline_a_task_page(s3_base_paths, vid_anno, match_anno, template_file='baseline_a.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    vid_setting = vid_anno.setting()
-    image_url = s3_base_paths['gifs'] + vid_anno.gid() + '.gif'
-    match_url = s3_base_paths['gifs'] + match_anno.gid() + '.gif'
-    char_tuples = []
-    strings_to_match = []
-    for char in vid_anno.data()['characters']:
-        char_name = char.data()['entityLabel']
-        strings_to_match.append(char_name)
-        char_url = s3_base_paths['subtask'] + char.gid() + '_taskb.png'
-        char_tuples.append((char_url, char_name))
-    strings_to_match.append(vid_setting)
-    strings_to_match = 'string_join_token'.join(strings_to_match)
-    page_html = template.render(s3_uri_base=s3_base_path, image_url=image_url, match_url=match_url,
-                                char_images=char_tuples, setting=vid_setting, strings_to_match=strings_to_match)
-    return page_html
+    return STAGES['baseline_a'].render(s3_base_paths, (vid_anno, match_anno), template_file=template_file)[0]
 
 
 def generate_stage_3_task_page(s3_base_paths, vid, template_file='stage_3a.html'):
-    env = Environment(loader=FileSystemLoader('hit_templates'))
-    template = env.get_template(template_file)
-    image_url = s3_base_paths['gifs'] + vid.gid() + '.gif'
-    page_html = template.render(s3_uri_base=s3_base_path, image_url=image_url)
-    page_html = page_html
-    return page_html
+    return STAGES['stage_3a'].render(s3_base_paths, vid, template_file=template_file)[0]
 
 
 def prepare_stage_2_hit(s3_base_path, img_uri, poses, position_prepositions, static_parameters, task_generator=generate_stage_2_task_page):
     question_html = task_generator(s3_base_path, img_uri, poses, position_prepositions)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_html]
 
 
 def prepare_stage_2b_hit(s3_base_path, img_uri, static_parameters, task_generator=generate_stage_2b_task_page):
     question_html = task_generator(s3_base_path, img_uri)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_html]
 
 
@@ -324,6 +274,7 @@ def prepare_baseline_a_hit(s3_base_path, img_uri, match_uri, static_parameters,
 
 def prepare_stage_4_hit(s3_base_path, still_id, n_objs, static_parameters):
     question_html = generate_stage_4_task_page(s3_base_path, still_id, n_objs)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_html]
 
 
@@ -335,40 +286,286 @@ def prepare_stage_4a_hit(still_id, description, static_parameters):
 
 
 def prepare_stage_4b_hit(video, static_parameters):
-    still_id = video.gid()
-    description = video.description()
-    objects = video._data['objects']
-    question_html = []
-    for obj in objects:
-        target_obj = obj.data()['localID']
-        target_span = obj.data()['labelSpan']
-        question_html.append(generate_stage_4b_task_page(still_id,
-                                                         rejoin_formatted_desc(description, target_span), target_obj))
+    question_html = STAGES['stage_4b'].render({}, video)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(qhtml, static_parameters) for qhtml in question_html]
 
 
 def prepare_segm_anno_hit(video, s3_base_path, static_parameters):
-    entities = video._data['objects'] + video._data['characters']
-    hit_html = [generate_segm_anno_task_page(ent, s3_base_path) for ent in entities]
+    hit_html = STAGES['segm_anno'].render({'segm': s3_base_path}, video)
+    static_parameters = prepare_static_params(static_parameters)
     return [build_hit_params(hhtml, static_parameters) for hhtml in hit_html]
 
 
+@lru_cache(maxsize=1024)
+def tokenize_description(description):
+    """
+    sentence/word tokenization of a description, cached since every object of a video marks the same text
+    :return: (tuple of sentences each a tuple of words, tuple of the space-joined sentences)
+    """
+    tokenized = tuple(tuple(sent.split()) for sent in sent_tokenize(description))
+    return tokenized, tuple(' '.join(sent) for sent in tokenized)
+
+
+@lru_cache(maxsize=1024)
+def split_description(description):
+    """
+    fallback tokenization on periods, used when a label span doesn't fit the nltk sentence split
+    """
+    tokenized = tuple(tuple(sent.split()) for sent in description.split('.'))
+    return tokenized, tuple(' '.join(sent) for sent in tokenized)
+
+
+def _mark_target(tokenization, replacement_span):
+    # only the target sentence is rebuilt, the others reuse their cached joins
+    tokenized_description, joined_sentences = tokenization
+    sent_idx, word_idx = replacement_span[0], replacement_span[1]
+    target_sent = list(tokenized_description[sent_idx])
+    target_sent[word_idx] = '<target>' + target_sent[word_idx] + '</target>'
+    sentences = list(joined_sentences)
+    sentences[sent_idx] = ' '.join(target_sent)
+    return ' '.join(sentences)
+
+
+class Stage:
+    """
+    declarative description of an annotation stage: which entities of a video get a HIT each,
+    the template their page is rendered from, and how the template context is built per entity
+    """
+
+    def __init__(self, name, template_file, entities, context, static_params=None):
+        """
+        :param name: registry key
+        :param template_file: template under hit_templates
+        :param entities: callable vid_anno -> entities to render one page for
+        :param context: callable (s3_base_paths, vid_anno, entity, **extra) -> template kwargs
+        :param static_params: stage specific HIT params layered under the batch's basic_hit_params
+        """
+        self.name = name
+        self.template_file = template_file
+        self.entities = entities
+        self.context = context
+        self.static_params = static_params or {}
+
+    def render_entity(self, s3_base_paths, vid_anno, entity, template_file=None, **extra):
+        template = get_template(template_file or self.template_file)
+        return template.render(**self.context(s3_base_paths, vid_anno, entity, **extra))
+
+    def render(self, s3_base_paths, vid_anno, template_file=None, **extra):
+        return [self.render_entity(s3_base_paths, vid_anno, entity, template_file, **extra)
+                for entity in self.entities(vid_anno)]
+
+
+STAGES = {}
+
+
+def register_stage(name, template_file, entities, context, static_params=None):
+    STAGES[name] = Stage(name, template_file, entities, context, static_params)
+    return STAGES[name]
+
+
+def _video_itself(vid_anno):
+    return [vid_anno]
+
+
+def _dict_characters(vid_anno):
+    return vid_anno['characters']
+
+
+def _characters(vid):
+    return vid.data()['characters']
+
+
+def _objects_with_marked_descriptions(video):
+    # every object marks the same description, so tokenize it once per video rather than once per object
+    objects = video._data['objects']
+    target_spans = [obj.data()['labelSpan'] for obj in objects]
+    return list(zip(objects, mark_description_targets(video.description(), target_spans)))
+
+
+def _objects_and_characters(vid):
+    return vid._data['objects'] + vid._data['characters']
+
+
+def _char_indices(still):
+    _, n_chars = still
+    return range(n_chars)
+
+
+def _character_bbox_context(s3_base_paths, img_id, _):
+    return {'s3_uri_base': s3_base_paths['stills'], 'image_id': img_id}
+
+
+def _char_index_context(s3_base_paths, still, char_idx):
+    img_id, _ = still
+    char_img = img_id.rsplit('_', 1)[0] + '_char_' + str(char_idx) + '_taskb.png'
+    return {'s3_uri_base': s3_base_paths['stills'], 'image_id': img_id, 'char_img': char_img}
+
+
+def _character_bbox_supl_context(s3_base_paths, still_char, _):
+    img_id, char_id = still_char
+    return {'s3_uri_base': s3_base_paths['stills'], 'image_id': img_id + '_taskb.png', 'char_img': char_id}
+
+
+def _stage_1b_context(s3_base_paths, vid, char):
+    return _character_bbox_supl_context(s3_base_paths, (vid.gid(), char.gid()), None)
+
+
+def _stage_2a_context(s3_base_paths, vid_anno, char, poses=None, position_prepositions=None):
+    image_url = s3_base_paths['stills'] + vid_anno['keyFrames'][0].replace('_40.png', '_10.png')
+    char_url = s3_base_paths['subtask'] + char['imageID']
+    return {'s3_uri_base': s3_base_path, 'image_url': image_url, 'char_img': char_url, 'pose_select': poses,
+            'position_select': position_prepositions}
+
+
+def _stage_2b_context(s3_base_paths, vid_anno, char):
+    image_url = s3_base_paths['gifs'] + vid_anno['globalID'] + '.gif'
+    char_url = s3_base_paths['subtask'] + char['imageID']
+    return {'s3_uri_base': s3_base_path, 'image_url': image_url, 'char_img': char_url}
+
+
+def _stage_3a_context(s3_base_paths, vid, _):
+    return {'s3_uri_base': s3_base_path, 'image_url': s3_base_paths['gifs'] + vid.gid() + '.gif'}
+
+
+def _stage_3b_context(s3_base_paths, vid_anno, _):
+    vid_setting = vid_anno.setting()
+    char_tuples = []
+    strings_to_match = []
+    for char in vid_anno.data()['characters']:
+        char_name = char.data()['entityLabel']
+        strings_to_match.append(char_name)
+        char_tuples.append((s3_base_paths['subtask'] + char.gid() + '_taskb.png', char_name))
+    strings_to_match.append(vid_setting)
+    return {'s3_uri_base': s3_base_path, 'image_url': s3_base_paths['gifs'] + vid_anno.gid() + '.gif',
+            'char_images': char_tuples, 'setting': vid_setting,
+            'strings_to_match': 'string_join_token'.join(strings_to_match)}
+
+
+def _baseline_a_context(s3_base_paths, vid_pair, _):
+    vid_anno, match_anno = vid_pair
+    return dict(_stage_3b_context(s3_base_paths, vid_anno, None),
+                match_url=s3_base_paths['gifs'] + match_anno.gid() + '.gif')
+
+
+def _stage_4a_context(s3_base_paths, still_desc, _):
+    img_id, formatted_description = still_desc
+    return {'image_id': img_id, 'formatted_description': formatted_description}
+
+
+def _stage_4b_context(s3_base_paths, video, marked_obj):
+    obj, marked_description = marked_obj
+    return {'s3_uri_base': s3_subtask_path, 'image_id': video.gid(), 'target_object': obj.data()['localID'],
+            'description': marked_description}
+
+
+def _segm_anno_context(s3_base_paths, video, ent):
+    return {'base_url': s3_base_paths['segm'], 'image_name': ent.gid() + '_bb.png',
+            'entity_label': ent.data()['entityLabel']}
+
+
+# the unit rendered for the older stages isn't a video annotation: character_bbox takes a still id,
+# character_bbox_simple and stage_4 a (still id, n_chars) pair with a page per character index,
+# character_bbox_supl a (still id, char id) pair, stage_4a (still id, formatted description)
+# and baseline_a (video, matched video)
+register_stage('character_bbox', 'character_bbox.html', _video_itself, _character_bbox_context)
+register_stage('character_bbox_simple', 'character_bbox_simple.html', _char_indices, _char_index_context)
+register_stage('character_bbox_supl', 'character_bbox_simple.html', _video_itself, _character_bbox_supl_context)
+register_stage('stage_1b', 'character_bbox_simple.html', _characters, _stage_1b_context)
+register_stage('stage_2a', 'stage_2a.html', _dict_characters, _stage_2a_context)
+register_stage('stage_2b', 'stage_2b.html', _dict_characters, _stage_2b_context)
+register_stage('stage_3a', 'stage_3a.html', _video_itself, _stage_3a_context)
+register_stage('stage_3b', 'stage_3b.html', _video_itself, _stage_3b_context)
+register_stage('baseline_a', 'baseline_a.html', _video_itself, _baseline_a_context)
+register_stage('stage_4', 'stage_4.html', _char_indices, _char_index_context)
+register_stage('stage_4a', 'stage_4a.html', _video_itself, _stage_4a_context)
+register_stage('stage_4b', 'stage_4b.html', _objects_with_marked_descriptions, _stage_4b_context)
+register_stage('segm_anno', 'img_seg.html', _objects_and_characters, _segm_anno_context)
+
+
+def _render_units(stage, units, s3_base_paths, extra):
+    return [stage.render_entity(s3_base_paths, vid_anno, entity, **extra) for vid_anno, entity in units]
+
+
+def render_stage(stage_name, videos, s3_base_paths, n_processes=None, chunk_size=64, **extra):
+    """
+    renders every (video, entity) page of a registered stage. template rendering is cpu bound python,
+    so chunks of pages are rendered on a process pool rather than on threads; a failed render raises
+    here instead of leaving a hole in the returned pages
+    :param stage_name: key in STAGES
+    :param videos: video annotations (or the stage's unit, see the registrations), must be picklable when
+                   rendering on more than one process
+    :param s3_base_paths: dict of asset base urls ('stills', 'gifs', 'subtask', 'segm')
+    :param n_processes: worker processes, defaults to the cpu count; 1 renders in this process
+    :param chunk_size: pages sent to a worker at a time
+    :param extra: additional context arguments for the stage, e.g. poses for stage_2a
+    :return: page html in video then entity order
+    """
+    stage = STAGES[stage_name]
+    units = [(vid_anno, entity) for vid_anno in videos for entity in stage.entities(vid_anno)]
+    chunks = [units[i:i + chunk_size] for i in range(0, len(units), chunk_size)]
+    n_processes = min(n_processes or os.cpu_count() or 1, len(chunks))
+    if n_processes <= 1:
+        return _render_units(stage, units, s3_base_paths, extra)
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        rendered = executor.map(_render_units, [stage] * len(chunks), chunks,
+                                [s3_base_paths] * len(chunks), [extra] * len(chunks))
+        return [page_html for pages in rendered for page_html in pages]
+
+
+def prepare_stage_hit_params(mturk, stage_name, videos, s3_base_paths, basic_hit_params, n_processes=None, **extra):
+    """
+    builds boto3 create_hit parameters for a stage, ready for MTurk.submit_hit_params
+    :param mturk: mturk.MTurk instance, used to wrap each page in question xml
+    :param basic_hit_params: HIT params shared by the batch, layered over the stage's static_params
+    :return: list of create_hit parameter dicts
+    """
+    param_template = mturk.build_param_template(dict(STAGES[stage_name].static_params, **basic_hit_params))
+    pages = render_stage(stage_name, videos, s3_base_paths, n_processes=n_processes, **extra)
+    return [mturk.create_question_hit_params(param_template, page_html) for page_html in pages]
+
+
 def rejoin_formatted_desc(description, replacement_span):
-    try:
-        tokenized_description = [sent.split() for sent in sent_tokenize(description)]
-        replace_word = tokenized_description[replacement_span[0]][replacement_span[1]]
-    except IndexError:
-        tokenized_description = [sent.split() for sent in description.split('.')]
-        replace_word = tokenized_description[replacement_span[0]][replacement_span[1]]
-    tokenized_description[replacement_span[0]][replacement_span[1]] = '<target>' + replace_word + '</target>'
-    joined_desc = ' '.join([' '.join([w for w in sent]) for sent in tokenized_description])
-    return joined_desc
+    return mark_description_targets(description, [replacement_span])[0]
+
+
+def mark_description_targets(description, replacement_spans):
+    """
+    produces one target-marked description per span from a single tokenization of the description
+    :param description: video description
+    :param replacement_spans: (sentence index, word index) label spans
+    :return: list of joined descriptions, in span order
+    """
+    tokenization = tokenize_description(description)
+    marked = []
+    for span in replacement_spans:
+        try:
+            marked.append(_mark_target(tokenization, span))
+        except IndexError:
+            marked.append(_mark_target(split_description(description), span))
+    return marked
 
 
 s3_base_path = 'https://s3-us-west-2.amazonaws.com/ai2-vision-animation-gan/annotation_data/still_frames/'
 s3_subtask_path = 'https://s3-us-west-2.amazonaws.com/ai2-vision-animation-gan/annotation_data/subtask_frames/'
 
 
-def display_image(still_id):
+def display_image(still_id, cache=None):
+    """
+    :param still_id: still frame file name under s3_base_path
+    :param cache: optional asset_cache.AssetCache to serve the frame from disk
+    """
     image_url = s3_base_path + still_id
-    return Image.open(requests.get(image_url, stream=True).raw)
\ No newline at end of file
+    if cache is not None:
+        return Image.open(cache.open(image_url))
+    return Image.open(requests.get(image_url, stream=True).raw)
+
+
+def prefetch_images(still_ids, cache, n_threads=8):
+    """
+    warms the asset cache with the still frames of the HIT results about to be reviewed
+    :param still_ids: still frame file names, in review order
+    :param cache: asset_cache.AssetCache used by display_image
+    :return: the prefetch threads
+    """
+    return cache.prefetch([s3_base_path + still_id for still_id in still_ids], n_threads=n_threads)
\ No newline at end of file
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict, Counter
+import requests
+
+
+class AssetCache:
+    """
+    content-addressed on-disk cache for task assets fetched over http (still frames, gifs, subtask crops).
+    blobs are stored under their sha256, urls map to blobs through a persisted index kept in LRU order,
+    and the least recently used entries are evicted once the cache grows past max_bytes. entries older
+    than max_age are revalidated with their ETag before being served.
+    """
+
+    def __init__(self, cache_dir='./asset_cache', max_bytes=2 * 1024 ** 3, max_age=3600, timeout=30,
+                 save_interval=5):
+        """
+        :param cache_dir directory for the blobs and index
+        :param max_bytes size bound of the stored blobs
+        :param max_age seconds an entry is served without revalidation, None to never revalidate
+        :param timeout http timeout in seconds
+        :param save_interval minimum seconds between index writes after downloads and evictions
+        """
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.save_interval = save_interval
+        if not os.path.exists(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        self.index = OrderedDict()
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = OrderedDict(json.load(f))
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._last_save = 0.
+        self._digest_refs = Counter(entry['digest'] for entry in self.index.values())
+        self._digest_sizes = {entry['digest']: entry['size'] for entry in self.index.values()}
+        self._total = sum(self._digest_sizes.values())
+        self._remove_orphans()
+        self._evict()
+
+    def _remove_orphans(self):
+        # blobs written after the last index save are not accounted for, drop them
+        for blob_name in os.listdir(self.blob_dir):
+            if blob_name not in self._digest_refs:
+                try:
+                    os.remove(self._blob_path(blob_name))
+                except OSError:
+                    pass
+
+    @property
+    def session(self):
+        # requests sessions aren't safe to share across threads, keep one pooled session per thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def total_bytes(self):
+        return self._total
+
+    def save(self):
+        with self._lock:
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(list(self.index.items()), f)
+            os.replace(tmp_file, self.index_file)
+            self._last_save = time.time()
+
+    def _maybe_save(self):
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _release(self, digest):
+        """
+        drops one url reference to a blob, deleting the blob once nothing references it
+        """
+        self._digest_refs[digest] -= 1
+        if self._digest_refs[digest] > 0:
+            return
+        del self._digest_refs[digest]
+        self._total -= self._digest_sizes.pop(digest, 0)
+        try:
+            os.remove(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def _store(self, url, content, etag):
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            tmp_path = f'{blob_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, blob_path)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                # another thread evicted the last reference to this blob while it was being written
+                with open(blob_path, 'wb') as f:
+                    f.write(content)
+            previous = self.index.get(url)
+            if digest not in self._digest_refs:
+                self._digest_sizes[digest] = len(content)
+                self._total += len(content)
+            self._digest_refs[digest] += 1
+            self.index[url] = {'digest': digest, 'etag': etag, 'size': len(content), 'checked': time.time()}
+            self.index.move_to_end(url)
+            if previous is not None:
+                self._release(previous['digest'])
+            self._evict()
+            self._maybe_save()
+        return blob_path
+
+    def _evict(self):
+        with self._lock:
+            while self._total > self.max_bytes and len(self.index) > 1:
+                _, entry = self.index.popitem(last=False)
+                self._release(entry['digest'])
+
+    def _checkout(self, url, digest, checked=None):
+        """
+        marks the entry as recently used if it still points at digest and its blob is still on disk.
+        eviction removes blobs under the same lock, so the check can't race with it
+        :return the blob path, or None if the entry or its blob is gone
+        """
+        blob_path = self._blob_path(digest)
+        with self._lock:
+            entry = self.index.get(url)
+            if entry is None or entry['digest'] != digest or not os.path.exists(blob_path):
+                return None
+            if checked:
+                entry['checked'] = checked
+            self.index.move_to_end(url)
+            return blob_path
+
+    def fetch(self, url):
+        """
+        :return local path of the asset, downloading or revalidating it if needed. with prefetch threads
+                running the blob can be evicted again after this returns, read it through open() instead
+        """
+        with self._lock:
+            entry = dict(self.index[url]) if url in self.index else None
+        if entry and (self.max_age is None or time.time() - entry['checked'] < self.max_age):
+            blob_path = self._checkout(url, entry['digest'])
+            if blob_path:
+                return blob_path
+        elif entry:
+            headers = {'If-None-Match': entry['etag']} if entry['etag'] else {}
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(e)
+                blob_path = self._checkout(url, entry['digest'])
+                if blob_path:
+                    return blob_path
+                raise
+            if response.status_code != 304:
+                response.raise_for_status()
+                return self._store(url, response.content, response.headers.get('ETag'))
+            blob_path = self._checkout(url, entry['digest'], checked=time.time())
+            if blob_path:
+                return blob_path
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return self._store(url, response.content, response.headers.get('ETag'))
+
+    def open(self, url, retries=3):
+        """
+        opens the asset for reading. the blob is opened under the lock, so a concurrent eviction can't
+        remove it in between, and an open handle stays readable if the blob is evicted afterwards
+        """
+        for _ in range(retries):
+            blob_path = self.fetch(url)
+            with self._lock:
+                if os.path.exists(blob_path):
+                    return open(blob_path, 'rb')
+        raise FileNotFoundError(f'{url} was evicted before it could be opened')
+
+    def prefetch(self, urls, n_threads=8, block=False):
+        """
+        warms the cache for urls on background threads
+        :param urls the asset urls, in the order they will be viewed
+        :param n_threads number of concurrent downloads
+        :param block wait for the downloads to finish
+        :return the started threads
+        """
+        batches = [urls[i::n_threads] for i in range(n_threads)]
+        threads = [PrefetchAssets(self, batch) for batch in batches if batch]
+        for thread in threads:
+            thread.start()
+        if block:
+            for thread in threads:
+                thread.join()
+            self.save()
+        return threads
+
+
+class PrefetchAssets(threading.Thread):
+    def __init__(self, cache, urls):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.urls = urls
+
+    def run(self):
+        for url in self.urls:
+            try:
+                self.cache.fetch(url)
+            except requests.RequestException as e:
+                print(e)
+        self.cache.save()
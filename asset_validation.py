@@ -0,0 +1,138 @@
+import re
+import json
+import html
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+URL_PATTERN = re.compile(r'''https?://[^\s"'<>()\\]+''')
+SRC_PATTERN = re.compile(r'''\bsrc\s*=\s*["']?(https?://[^\s"'<>()\\]+)''', re.IGNORECASE)
+CDATA_PATTERN = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+
+def extract_asset_urls(question, asset_prefixes=None):
+    """
+    pulls the asset urls out of a rendered HIT. for HTMLQuestion xml only the html inside the
+    CDATA block is searched, so the schema namespace isn't treated as an asset
+    :param question rendered html or HTMLQuestion xml
+    :param asset_prefixes optional asset base urls, e.g. s3_base_paths.values(); if given every url under
+           one of them is an asset, wherever it appears in the page, otherwise only src attribute urls are
+    :return sorted list of distinct urls, without bare prefixes / directory urls
+    """
+    blocks = CDATA_PATTERN.findall(question) or [question]
+    asset_prefixes = tuple(asset_prefixes) if asset_prefixes else None
+    pattern = URL_PATTERN if asset_prefixes else SRC_PATTERN
+    urls = set()
+    for block in blocks:
+        for url in pattern.findall(block):
+            url = html.unescape(url).rstrip('.,;')
+            if url.endswith('/'):
+                continue
+            if asset_prefixes and not url.startswith(asset_prefixes):
+                continue
+            urls.add(url)
+    return sorted(urls)
+
+
+class AssetValidator:
+    """
+    checks that the assets referenced by rendered HITs exist before they are submitted.
+    urls are checked with concurrent HEAD requests, each thread through its own pooled session, and urls found
+    valid are remembered (optionally on disk) so later batches don't check them again.
+    """
+
+    def __init__(self, n_threads=16, timeout=10, cache_file=None, asset_prefixes=None):
+        """
+        :param n_threads number of concurrent checks
+        :param timeout http timeout in seconds
+        :param cache_file optional json file remembering the urls found valid
+        :param asset_prefixes optional asset base urls limiting what is checked, see extract_asset_urls
+        """
+        self.n_threads = n_threads
+        self.asset_prefixes = tuple(asset_prefixes) if asset_prefixes else None
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.valid = set()
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.valid = set(json.load(f))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # requests sessions aren't safe to share across threads, keep one pooled session per thread
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.n_threads, pool_maxsize=4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return self._local.session
+
+    def save(self):
+        if self.cache_file:
+            with self._lock:
+                with open(self.cache_file, 'w') as f:
+                    json.dump(sorted(self.valid), f)
+
+    def check_url(self, url):
+        """
+        :return None if the url is reachable, otherwise the status code or error message
+        """
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            if response.status_code == 405:
+                response = self.session.get(url, timeout=self.timeout, stream=True)
+                response.close()
+        except requests.RequestException as e:
+            return str(e)
+        if response.status_code >= 400:
+            return response.status_code
+        with self._lock:
+            self.valid.add(url)
+        return None
+
+    def check_urls(self, urls):
+        """
+        :return dict of failing url -> status code or error, for the urls not already known to be valid
+        """
+        unchecked = sorted(set(urls) - self.valid)
+        batches = [unchecked[i::self.n_threads] for i in range(self.n_threads)]
+        threads = [CheckAssets(self, batch) for batch in batches if batch]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.save()
+        return {url: error for thread in threads for url, error in thread.failures.items()}
+
+    def validate(self, hit_params):
+        """
+        :param hit_params boto3 create_hit parameters with a rendered Question
+        :return dict of position in hit_params -> {url: error} for HITs referencing broken assets
+        """
+        hit_urls = [extract_asset_urls(params['Question'], self.asset_prefixes) for params in hit_params]
+        failures = self.check_urls([url for urls in hit_urls for url in urls])
+        report = {}
+        for i, urls in enumerate(hit_urls):
+            broken = {url: failures[url] for url in urls if url in failures}
+            if broken:
+                report[i] = broken
+        return report
+
+
+class CheckAssets(threading.Thread):
+    def __init__(self, validator, urls):
+        super().__init__()
+        self.validator = validator
+        self.urls = urls
+        self.failures = {}
+
+    def run(self):
+        for url in self.urls:
+            error = self.validator.check_url(url)
+            if error is not None:
+                self.failures[url] = error
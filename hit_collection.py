@@ -0,0 +1,136 @@
+import bisect
+import datetime
+from collections import defaultdict
+
+
+def _field(hit, name):
+    """
+    reads a field from a boto3 style dict / HITRecord, or from a legacy boto HIT object
+    """
+    if hasattr(hit, 'get'):
+        return hit.get(name)
+    return getattr(hit, name, None)
+
+
+def _to_datetime(value):
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        import dateutil.parser as dt_parse
+        value = dt_parse.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+class HITCollection:
+    """
+    in-memory HIT collection that parses CreationTime once and keeps a sorted time index plus hash
+    indexes on status, HIT type, completion count and creation day/hour. queries bisect the time index
+    and intersect the hash indexes instead of scanning every HIT.
+    """
+
+    def __init__(self, hits=()):
+        self.hits = []
+        self.created = []
+        self._time_keys = []
+        self._time_positions = []
+        self._indexes = {
+            'status': defaultdict(set),
+            'hit_type_id': defaultdict(set),
+            'n_completed': defaultdict(set),
+            'day': defaultdict(set),
+            'hour': defaultdict(set),
+            'hour_of_day': defaultdict(set),
+        }
+        self.add(hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def add(self, hits):
+        new_times = []
+        for hit in hits:
+            position = len(self.hits)
+            created = _to_datetime(_field(hit, 'CreationTime'))
+            self.hits.append(hit)
+            self.created.append(created)
+            if created is not None:
+                new_times.append((created.timestamp(), position))
+                self._indexes['day'][created.day].add(position)
+                self._indexes['hour'][(created.day, created.hour)].add(position)
+                self._indexes['hour_of_day'][created.hour].add(position)
+            self._indexes['status'][_field(hit, 'HITStatus')].add(position)
+            self._indexes['hit_type_id'][_field(hit, 'HITTypeId')].add(position)
+            n_completed = _field(hit, 'NumberOfAssignmentsCompleted')
+            if n_completed is not None:
+                self._indexes['n_completed'][int(n_completed)].add(position)
+        if new_times:
+            # one sort per call; timsort merges the existing sorted run with the new batch in linear time
+            time_index = sorted(list(zip(self._time_keys, self._time_positions)) + new_times)
+            self._time_keys = [time_key for time_key, _ in time_index]
+            self._time_positions = [position for _, position in time_index]
+
+    def _time_range(self, start=None, end=None):
+        """
+        positions of HITs created strictly between start and end, in creation order
+        """
+        lo = 0 if start is None else bisect.bisect_right(self._time_keys, _to_datetime(start).timestamp())
+        hi = len(self._time_keys) if end is None else bisect.bisect_left(self._time_keys, _to_datetime(end).timestamp())
+        return self._time_positions[lo:hi]
+
+    def query(self, start=None, end=None, status=None, hit_type_id=None, n_completed=None, day=None, hour=None):
+        """
+        compound query over the indexes; unspecified criteria are not applied
+        :param start only HITs created after this datetime
+        :param end only HITs created before this datetime
+        :param status HITStatus value
+        :param hit_type_id HITTypeId value
+        :param n_completed exact NumberOfAssignmentsCompleted
+        :param day day of month of CreationTime
+        :param hour hour of CreationTime, on the given day or on any day if day isn't given
+        :return list of matching HITs, in creation order if a time range was given
+        """
+        candidates = []
+        if status is not None:
+            candidates.append(self._indexes['status'].get(status, set()))
+        if hit_type_id is not None:
+            candidates.append(self._indexes['hit_type_id'].get(hit_type_id, set()))
+        if n_completed is not None:
+            candidates.append(self._indexes['n_completed'].get(int(n_completed), set()))
+        if day is not None and hour is not None:
+            candidates.append(self._indexes['hour'].get((day, hour), set()))
+        elif day is not None:
+            candidates.append(self._indexes['day'].get(day, set()))
+        elif hour is not None:
+            candidates.append(self._indexes['hour_of_day'].get(hour, set()))
+
+        if start is not None or end is not None:
+            ordered = self._time_range(start, end)
+            if candidates:
+                selected = set.intersection(*candidates)
+                ordered = [position for position in ordered if position in selected]
+            return [self.hits[position] for position in ordered]
+        if not candidates:
+            return list(self.hits)
+        candidates.sort(key=len)
+        selected = set.intersection(*candidates)
+        return [self.hits[position] for position in sorted(selected)]
+
+    def created_between(self, start, end):
+        return self.query(start=start, end=end)
+
+    def created_on(self, day_of_month, hour=None):
+        return self.query(day=day_of_month, hour=hour)
+
+    def with_status(self, status='Reviewable'):
+        return self.query(status=status)
+
+    def with_completion(self, n_assignments=3):
+        return self.query(n_completed=n_assignments)
+
+    def of_hit_type(self, hit_type_id):
+        return self.query(hit_type_id=hit_type_id)
@@ -0,0 +1,173 @@
+import os
+import json
+import mmap
+import hashlib
+import datetime
+
+
+STORE_FORMAT = 'mturk-hit-store'
+STORE_VERSION = 1
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+class HITRecordStore:
+    """
+    append-only on-disk store for HIT and assignment records, replacing pickle_this for batch records.
+    records are written as json lines into fixed-size chunk files, Question XML is stored once per
+    distinct payload, and an id index allows single records to be read from memory-mapped chunks
+    without loading the rest of the batch.
+
+    layout of store_dir:
+        manifest.json        format name, version and chunk size
+        chunk_00000.jsonl    record lines, at most chunk_size records per file
+        index.jsonl          one line per record: kind, id, chunk, offset, length
+        payloads.bin         deduplicated question payloads
+        payloads.jsonl       one line per payload: digest, offset, length
+    """
+
+    def __init__(self, store_dir, chunk_size=10000):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        manifest_file = os.path.join(store_dir, 'manifest.json')
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get('format') != STORE_FORMAT or manifest.get('version') != STORE_VERSION:
+                raise ValueError(f'unsupported store format in {store_dir}: {manifest}')
+            self.chunk_size = manifest['chunk_size']
+        else:
+            self.chunk_size = chunk_size
+            with open(manifest_file, 'w') as f:
+                json.dump({'format': STORE_FORMAT, 'version': STORE_VERSION, 'chunk_size': chunk_size}, f)
+        self.index = {'hit': {}, 'assignment': {}}
+        self.payloads = {}
+        self._chunk_counts = {}
+        self._maps = {}
+        self._load_indexes()
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    @staticmethod
+    def _chunk_name(chunk):
+        return f'chunk_{chunk:05d}.jsonl'
+
+    def _load_indexes(self):
+        if os.path.exists(self._path('index.jsonl')):
+            with open(self._path('index.jsonl')) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.index[entry['kind']][entry['id']] = (entry['chunk'], entry['offset'], entry['length'])
+                    self._chunk_counts[entry['chunk']] = self._chunk_counts.get(entry['chunk'], 0) + 1
+        if os.path.exists(self._path('payloads.jsonl')):
+            with open(self._path('payloads.jsonl')) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.payloads[entry['digest']] = (entry['offset'], entry['length'])
+
+    def __len__(self):
+        return len(self.index['hit']) + len(self.index['assignment'])
+
+    def __contains__(self, record_id):
+        return record_id in self.index['hit'] or record_id in self.index['assignment']
+
+    def _store_payload(self, payload, payload_file, payload_index):
+        data = payload.encode('utf8')
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in self.payloads:
+            offset = payload_file.seek(0, os.SEEK_END)
+            payload_file.write(data)
+            self.payloads[digest] = (offset, len(data))
+            payload_index.write(json.dumps({'digest': digest, 'offset': offset, 'length': len(data)}) + '\n')
+        return digest
+
+    def append(self, records, kind='hit'):
+        """
+        appends records to the store without rewriting existing chunks
+        :param records create_hit responses / HIT dicts (kind='hit') or assignment dicts (kind='assignment')
+        :param kind 'hit' or 'assignment'
+        :return the number of records written
+        """
+        id_field = 'HITId' if kind == 'hit' else 'AssignmentId'
+        chunk = max(self._chunk_counts) if self._chunk_counts else 0
+        written = 0
+        with open(self._path('index.jsonl'), 'a') as index_file, \
+                open(self._path('payloads.bin'), 'ab') as payload_file, \
+                open(self._path('payloads.jsonl'), 'a') as payload_index:
+            chunk_file = None
+            for record in records:
+                if record is None:
+                    continue
+                record = dict(record.get('HIT', record)) if kind == 'hit' else dict(record)
+                record.pop('ResponseMetadata', None)
+                if isinstance(record.get('Question'), str):
+                    record['Question'] = {'__payload__': self._store_payload(record['Question'], payload_file,
+                                                                             payload_index)}
+                if chunk_file is None or self._chunk_counts.get(chunk, 0) >= self.chunk_size:
+                    if chunk_file is not None:
+                        chunk_file.close()
+                    if self._chunk_counts.get(chunk, 0) >= self.chunk_size:
+                        chunk += 1
+                    chunk_file = open(self._path(self._chunk_name(chunk)), 'ab')
+                line = (json.dumps(record, default=_encode) + '\n').encode('utf8')
+                offset = chunk_file.seek(0, os.SEEK_END)
+                chunk_file.write(line)
+                self.index[kind][record[id_field]] = (chunk, offset, len(line))
+                self._chunk_counts[chunk] = self._chunk_counts.get(chunk, 0) + 1
+                index_file.write(json.dumps({'kind': kind, 'id': record[id_field], 'chunk': chunk,
+                                             'offset': offset, 'length': len(line)}) + '\n')
+                written += 1
+            if chunk_file is not None:
+                chunk_file.close()
+        return written
+
+    def _read(self, file_name, offset, length):
+        mapped = self._maps.get(file_name)
+        if mapped is None or offset + length > len(mapped):
+            if mapped is not None:
+                mapped.close()
+            with open(self._path(file_name), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[file_name] = mapped
+        return mapped[offset:offset + length]
+
+    def question(self, digest):
+        offset, length = self.payloads[digest]
+        return self._read('payloads.bin', offset, length).decode('utf8')
+
+    def get(self, record_id, kind='hit', with_question=False):
+        """
+        reads a single record by HITId (or AssignmentId) without loading the rest of the store
+        :param with_question replace the payload reference with the original Question XML
+        """
+        chunk, offset, length = self.index[kind][record_id]
+        record = json.loads(self._read(self._chunk_name(chunk), offset, length), object_hook=_decode)
+        question = record.get('Question')
+        if isinstance(question, dict) and '__payload__' in question and with_question:
+            record['Question'] = self.question(question['__payload__'])
+        return record
+
+    def iter_records(self, ids=None, kind='hit', with_question=False):
+        ids = self.index[kind].keys() if ids is None else ids
+        for record_id in ids:
+            yield self.get(record_id, kind=kind, with_question=with_question)
+
+    def load(self, ids=None, kind='hit', with_question=False):
+        return list(self.iter_records(ids, kind=kind, with_question=with_question))
+
+    def close(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
@@ -1,4 +1,5 @@
 import os
+import json
 import boto3
 import pickle
 import copy
@@ -7,11 +8,17 @@ import queue
 import xmltodict
 import pickle
 from tqdm import tqdm
+import sys
 import time
 import datetime
 import threading
+import contextlib
+from functools import lru_cache
+from types import MappingProxyType
+from collections.abc import Mapping
 import jinja2
 from botocore.exceptions import ClientError
+from notifications import NOTIFICATION_VERSION
 
 
 class MturkClient:
@@ -34,13 +41,16 @@ class MturkClient:
 
         self.mturk_environment = environments['live'] if not kwargs['in_sandbox'] else environments['sandbox']
 
-        session = boto3.Session(profile_name=kwargs['profile_name'])
-        self.client = session.client(
+        self.session = boto3.Session(profile_name=kwargs['profile_name'])
+        self.credentials = {
+            'aws_access_key_id': kwargs['aws_access_key_id'],
+            'aws_secret_access_key': kwargs['aws_secret_access_key'],
+        }
+        self.client = self.session.client(
             service_name='mturk',
             region_name='us-east-1',
             endpoint_url=self.mturk_environment['endpoint'],
-            aws_access_key_id=kwargs['aws_access_key_id'],
-            aws_secret_access_key=kwargs['aws_secret_access_key']
+            **self.credentials
         )
         # print(self.client)
 
@@ -110,14 +120,20 @@ class MTurk:
         self.n_threads = kwargs['n_threads']
         self.in_sandbox = kwargs['in_sandbox']
         self.s3_base_path = kwargs['s3_base_path']
+        self.record_store = kwargs.get('record_store')
+        self.profiler = kwargs.get('profiler')
         self.turk_data_schemas = {
             'html': 'http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2011-11-11/HTMLQuestion.xsd'
         }
         self.qualifications = {
             'high_accept_rate': 95,
             'english_speaking': ['US', 'CA', 'AU', 'NZ', 'GB'],
-            'us_only': ['US']
+            'us_only': ['US'],
+            'masters': False,
+            'allowlist': [],
+            'blocklist': [],
         }
+        self.grants = WorkerGrantCache(kwargs.get('grant_cache_file'))
         self.print_balance()
 
 
@@ -128,6 +144,22 @@ class MTurk:
     #         nt.start()
     #     t2.join()
 
+    def enable_profiling(self, profiler):
+        """
+        records per phase timings of the bulk operations, including those run on worker threads
+        :param profiler a profiling.PhaseProfiler, or None to stop profiling. the profiler being replaced is closed
+        """
+        if self.profiler is not None and self.profiler is not profiler:
+            self.profiler.close()
+        self.profiler = profiler
+        self.kwargs['profiler'] = profiler
+
+    def _phase(self, name):
+        return _phase(self.profiler, name)
+
+    def _item(self, name, label):
+        return _item(self.profiler, name, label)
+
     def get_num_balance(self):
         try:
             balance_response = self.amt.client.get_account_balance()
@@ -140,13 +172,22 @@ class MTurk:
         balance = self.get_num_balance()
         print(f'Account balance is: ${balance:.{2}f}')
 
-    def _build_qualifications(self, locales=None):
+    def _build_qualifications(self, locales=None, masters=None, allowlist=None, blocklist=None):
+        """
+        :param locales countries workers must be located in
+        :param masters require the masters qualification, defaults to self.qualifications['masters']
+        :param allowlist custom qualification type ids workers must hold, defaults to self.qualifications['allowlist']
+        :param blocklist custom qualification type ids workers must not hold, defaults to self.qualifications['blocklist']
+        """
         if locales:
             locales = [{'Country': loc} for loc in locales]
+        masters = self.qualifications['masters'] if masters is None else masters
+        allowlist = self.qualifications['allowlist'] if allowlist is None else allowlist
+        blocklist = self.qualifications['blocklist'] if blocklist is None else blocklist
         masters_id = '2ARFPLSP75KLA8M8DH1HTEQVJT3SY6' if self.in_sandbox else '2F1QJWKUDD8XADTFD2Q0G6UTO95ALH'
         master = {
             'QualificationTypeId': masters_id,
-            'Comparator': 'EqualTo',
+            'Comparator': 'Exists',
             'RequiredToPreview': True,
         }
         high_accept_rate = {
@@ -161,12 +202,28 @@ class MTurk:
             'LocaleValues': locales,
             'RequiredToPreview': True,
         }
-        return [high_accept_rate, location_based]
+        requirements = [high_accept_rate]
+        if locales:
+            requirements.append(location_based)
+        if masters:
+            requirements.append(master)
+        for qualification_type_id in allowlist:
+            requirements.append({
+                'QualificationTypeId': qualification_type_id,
+                'Comparator': 'Exists',
+                'RequiredToPreview': True,
+            })
+        for qualification_type_id in blocklist:
+            requirements.append({
+                'QualificationTypeId': qualification_type_id,
+                'Comparator': 'DoesNotExist',
+                'RequiredToPreview': True,
+            })
+        return requirements
 
     @classmethod
     def _render_hit_html(cls, template_params, **kwargs):
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_params['template_dir']))
-        template = env.get_template(template_params['template_file'])
+        template = get_template(template_params['template_file'], template_params['template_dir'])
         hit_html = template.render(**kwargs)
         return hit_html
 
@@ -214,25 +271,125 @@ class MTurk:
         # :param params a dict of the HIT parameters, must contain a "html" parameter
         # :return the created HIT object
         """
-        hit_params = copy.deepcopy(basic_hit_params)
-        frame_height = hit_params.pop('frame_height')
-        question_html = self._render_hit_html(template_params, **kwargs)
-        hit_params['Question'] = self._create_question_xml(question_html, frame_height)
-        hit_params['QualificationRequirements'] = self._build_qualifications(self.qualifications['english_speaking'])
-        return hit_params
+        with self._phase('render'):
+            question_html = self._render_hit_html(template_params, **kwargs)
+        return self.create_question_hit_params(basic_hit_params, question_html)
+
+    def build_param_template(self, basic_hit_params):
+        """
+        builds the batch-wide create_hit parameters once, including the qualification requirements
+        :param basic_hit_params HIT params shared by the batch, with a frame_height entry
+        :return HITParamTemplate
+        """
+        if isinstance(basic_hit_params, HITParamTemplate):
+            return basic_hit_params
+        with self._phase('param_template'):
+            return HITParamTemplate(basic_hit_params,
+                                    self._build_qualifications(self.qualifications['english_speaking']))
 
-    def create_hit_group(self, data, task_param_generator, **kwargs):
-        if not self.expected_cost(data, **kwargs):
+    def create_question_hit_params(self, basic_hit_params, question_html):
+        """
+        builds boto3 create_hit parameters around already rendered question html
+        :param basic_hit_params a HITParamTemplate, or a dict of HIT params to build one from
+        """
+        param_template = self.build_param_template(basic_hit_params)
+        with self._phase('question_xml'):
+            question = self._create_question_xml(question_html, param_template.frame_height)
+        return param_template.overlay(Question=question)
+
+    def create_hit_group(self, data, task_param_generator, asset_validator=None, drop_invalid=False,
+                         submission_index=None, input_key=None, **kwargs):
+        """
+        renders and submits one HIT per data point
+        :param asset_validator optional asset_validation.AssetValidator checking the urls in each rendered HIT
+        :param drop_invalid submit the HITs whose assets are reachable instead of blocking the whole batch
+        :param submission_index optional submission_index.SubmissionIndex; data points already submitted
+               with the same template and parameters are skipped, and new HITs are recorded in it
+        :param input_key optional callable giving a stable key for a data point, defaults to its position in data.
+               the key is stored in each HIT's RequesterAnnotation, after the batch tag taken from
+               basic_hit_params['RequesterAnnotation'] if one is set
+        :return HITGroup keyed by input key, or None if the balance doesn't cover the batch. if asset validation
+                blocks the batch the group is empty, with the broken assets in its failures
+        """
+        input_keys = [str(input_key(point)) if input_key else str(i) for i, point in enumerate(data)]
+        if len(set(input_keys)) < len(input_keys):
+            raise ValueError('input keys must be unique within a batch')
+        batch_tag = kwargs['basic_hit_params'].get('RequesterAnnotation')
+        annotations = [HITGroup.annotation(batch_tag, key) for key in input_keys]
+        group = HITGroup(batch_tag)
+        group.data = dict(zip(input_keys, data))
+        with self._phase('task_param_generator'):
+            task_params = [task_param_generator(point, self.s3_base_path) for point in data]
+        content_keys = None
+        if submission_index is not None:
+            template_params = kwargs.get('template_params')
+            render_kwargs = {k: v for k, v in kwargs.items() if k not in ('basic_hit_params', 'template_params')}
+            content_keys = [submission_index.content_key(params.get('template_params', template_params),
+                                                         dict(render_kwargs, **{k: v for k, v in params.items()
+                                                                                if k != 'template_params'}))
+                            for params in task_params]
+            batch_keys = set()
+            new_positions = []
+            for i, key in enumerate(content_keys):
+                if key not in submission_index and key not in batch_keys:
+                    batch_keys.add(key)
+                    new_positions.append(i)
+            if len(new_positions) < len(content_keys):
+                print(f'Skipping {len(content_keys) - len(new_positions)} of {len(content_keys)} '
+                      f'data points already submitted.')
+            task_params = [task_params[i] for i in new_positions]
+            content_keys = [content_keys[i] for i in new_positions]
+            annotations = [annotations[i] for i in new_positions]
+            if not task_params:
+                return group
+        if not self.expected_cost(task_params, **kwargs):
             return None
-        hit_params = [self.create_html_hit_params(**kwargs, **task_param_generator(point, self.s3_base_path)) for point in data]
-        hit_batches = [hit_params[i::self.n_threads] for i in range(self.n_threads)]
-        # print(len(hit_batches))
-        # _ = [print(len(b)) for b in hit_batches]
+        kwargs['basic_hit_params'] = self.build_param_template(kwargs['basic_hit_params'])
+        hit_params = []
+        for position, (annotation, params) in enumerate(zip(annotations, task_params)):
+            with self._item('build_hit_params', position):
+                point_params = self.create_html_hit_params(**kwargs, **params)
+            point_params['RequesterAnnotation'] = annotation
+            hit_params.append(point_params)
+        submitted = self.submit_hit_params(hit_params, asset_validator, drop_invalid, submission_index, content_keys)
+        submitted.data = group.data
+        return submitted
+
+    def submit_hit_params(self, hit_params, asset_validator=None, drop_invalid=False, submission_index=None,
+                          content_keys=None):
+        """
+        submits prepared boto3 create_hit parameters across n_threads. unlike create_hit_group this
+        doesn't check the balance, call expected_cost first
+        :param hit_params list of create_hit parameter dicts
+        :param asset_validator see create_hit_group
+        :param drop_invalid see create_hit_group
+        :param submission_index optional submission_index.SubmissionIndex to record the created HITs in
+        :param content_keys content keys of hit_params, required with submission_index
+        :return HITGroup keyed by the input key in each RequesterAnnotation, or by position in hit_params if the
+                annotations weren't written by HITGroup.annotation, with the error of each HIT that wasn't created
+                (or its broken assets) in its failures
+        """
+        parsed = [HITGroup.parse_annotation(params.get('RequesterAnnotation')) for params in hit_params]
+        input_keys = [input_key for _, input_key in parsed]
+        if None in input_keys or len(set(input_keys)) < len(input_keys):
+            input_keys = [str(position) for position in range(len(hit_params))]
+            group = HITGroup()
+        else:
+            group = HITGroup(parsed[0][0])
+        positions = list(range(len(hit_params)))
+        if asset_validator is not None:
+            with self._phase('asset_validation'):
+                positions, asset_failures = self._validate_assets(hit_params, asset_validator, drop_invalid)
+            for position, broken in asset_failures.items():
+                group.add(input_keys[position], error=broken)
+            if not positions:
+                return group
+        hit_batches = [positions[i::self.n_threads] for i in range(self.n_threads)]
         threads = []
         res_queue = queue.Queue()
 
         for batch in hit_batches:
-            t = CreateHits(batch, res_queue, **self.kwargs)
+            t = CreateHits([(position, hit_params[position]) for position in batch], res_queue, **self.kwargs)
             threads.append(t)
 
         for thread in threads:
@@ -243,11 +400,38 @@ class MTurk:
 
         result_list = []
         while not res_queue.empty():
-            result_list.append(res_queue.get())
+            result_list.extend(res_queue.get())
 
-        hits_created = [item for sl in result_list for item in sl]
-        self.pickle_this(hits_created, f'submitted_batch_{len(hits_created)}')
-        return hits_created
+        result_list.sort(key=lambda result: result[0])
+        for position, response, error in result_list:
+            group.add(input_keys[position], response, error)
+        if submission_index is not None:
+            submission_index.add((content_keys[position], response['HIT']['HITId'])
+                                 for position, response, _ in result_list if response is not None)
+        hits_created = [response for _, response, _ in result_list]
+        with self._phase('save_records'):
+            if self.record_store is not None:
+                self.record_store.append(hits_created)
+            else:
+                self.pickle_this(hits_created, f'submitted_batch_{len(hits_created)}')
+        return group
+
+    @staticmethod
+    def _validate_assets(hit_params, asset_validator, drop_invalid=False):
+        """
+        :return positions in hit_params that may be submitted, and the broken assets by position
+        """
+        failures = asset_validator.validate(hit_params)
+        if not failures:
+            return list(range(len(hit_params))), failures
+        for i, broken in failures.items():
+            for url, error in broken.items():
+                print(f'HIT {i}: asset {url} failed ({error})')
+        if not drop_invalid:
+            print(f'{len(failures)} of {len(hit_params)} HITs reference missing assets, batch not submitted.')
+            return [], failures
+        print(f'Dropping {len(failures)} of {len(hit_params)} HITs with missing assets.')
+        return [i for i in range(len(hit_params)) if i not in failures], failures
 
     def expected_cost(self, data, **kwargs):
         hit_params = kwargs['basic_hit_params']
@@ -261,19 +445,92 @@ class MTurk:
             print(f'Batch will cost ${cost_plus_fee:.{2}f}')
             return cost_plus_fee
 
-    def get_all_hits(self):
+    def iter_hits(self, fields=None, annotations=None):
+        """
+        lazily pages through list_hits
+        :param fields optional HIT fields to keep; if given, yields compact HITRecords without the Question body
+        :param annotations optional collection of RequesterAnnotation values (batch tags) to keep
+        :return generator of HIT dicts (or HITRecords)
+        """
         paginator = self.amt.client.get_paginator('list_hits')
         response_iterator = paginator.paginate(
             PaginationConfig={
                 'PageSize': 100,
             }
         )
-        response = []
+        projection = HITProjection(fields) if fields else None
         for r in response_iterator:
-            response.extend(r['HITs'])
-        return response
+            for hit in r['HITs']:
+                if annotation_filter(annotations, hit):
+                    yield projection(hit) if projection else hit
+
+    def get_all_hits(self, fields=None, annotations=None):
+        """
+        :param fields optional HIT fields to keep, see iter_hits. HITProjection.default_fields covers
+               what the rest of this class reads from a HIT
+        :param annotations optional collection of RequesterAnnotation values (batch tags) to keep
+        """
+        return list(self.iter_hits(fields, annotations))
+
+    def get_reviewable_hits(self, hit_type_ids=None, annotations=None, status='Reviewable', fields=None):
+        """
+        lists only reviewable HITs rather than scanning the whole account. when HIT types are given each
+        type is paginated separately, spread across n_threads
+        :param hit_type_ids optional HIT types to scope the query to
+        :param annotations optional collection of RequesterAnnotation values (batch tags) to keep
+        :param status Reviewable or Reviewing
+        :param fields optional HIT fields to keep, see iter_hits
+        :return list of HIT dicts (or HITRecords). if listing any HIT type fails the error is raised once
+                every type has been tried, rather than returning a partial list
+        """
+        if not hit_type_ids:
+            projection = HITProjection(fields) if fields else None
+            return list(iter_reviewable_hits(self.amt.client, None, status, annotations, projection))
+        hit_type_ids = list(hit_type_ids)
+        type_batches = [hit_type_ids[i::self.n_threads] for i in range(self.n_threads)]
+        threads = [ListReviewableHits(batch, status, annotations, fields, **self.kwargs)
+                   for batch in type_batches if batch]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        failed = {hit_type_id: error for thread in threads for hit_type_id, error in thread.failed.items()}
+        for hit_type_id, error in failed.items():
+            print(f'listing reviewable HITs of type {hit_type_id} failed: {error}')
+        if failed:
+            raise next(iter(failed.values()))
+        return [hit for thread in threads for hit in thread.hits]
+
+    def get_hits(self, hit_ids, fields=None):
+        """
+        fetches the given HITs with get_hit, spread across n_threads, rather than listing the whole account
+        :param hit_ids the HITs to fetch
+        :param fields optional HIT fields to keep, see iter_hits
+        :return list of HIT dicts (or HITRecords); HITs that couldn't be fetched are left out
+        """
+        hit_ids = list(hit_ids)
+        hit_batches = [hit_ids[i::self.n_threads] for i in range(self.n_threads)]
+        threads = [GetHits(batch, fields, **self.kwargs) for batch in hit_batches if batch]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return [hit for thread in threads for hit in thread.hits]
+
+    def get_hit_question(self, hit):
+        """
+        refetches the Question XML dropped from a projected HIT record
+        """
+        return self.amt.client.get_hit(HITId=hit['HITId'])['HIT']['Question']
 
     def expire_hits(self, hits):
+        hits = _unwrap_hits(hits)
         hit_batches = [hits[i::self.n_threads] for i in range(self.n_threads)]
         threads = []
         for batch in hit_batches:
@@ -296,6 +553,7 @@ class MTurk:
                     print(e)
 
     def force_delete_hits(self, hits):
+        hits = _unwrap_hits(hits)
         self.expire_hits(hits)
         self.delete_hits(hits)
 
@@ -310,11 +568,12 @@ class MTurk:
         if not hits:
             hits = self.get_all_hits()
         for hit in hits:
-            assignments.append(self.amt.client.list_assignments_for_hit(
-                HITId=hit['HITId'],
-                AssignmentStatuses=['Submitted', 'Approved'],
-                MaxResults=10)
-            )
+            with self._phase('list_assignments_for_hit'):
+                assignments.append(self.amt.client.list_assignments_for_hit(
+                    HITId=hit['HITId'],
+                    AssignmentStatuses=['Submitted', 'Approved'],
+                    MaxResults=10)
+                )
         return assignments
 
     def approve_assignments(self, assignments):
@@ -323,19 +582,315 @@ class MTurk:
                 if assignment['AssignmentStatus'] == 'Submitted':
                     assignment_id = assignment['AssignmentId']
                     print('Approving Assignment {}'.format(assignment_id))
-                    self.amt.client.approve_assignment(
-                        AssignmentId=assignment_id,
-                        RequesterFeedback='good',
-                        OverrideRejection=False,
-                    )
+                    with self._phase('approve_assignment'):
+                        self.amt.client.approve_assignment(
+                            AssignmentId=assignment_id,
+                            RequesterFeedback='good',
+                            OverrideRejection=False,
+                        )
+
+    def create_qualification_type(self, name, description, keywords=''):
+        """
+        creates a custom qualification type to use as a worker allowlist or blocklist, or returns
+        the existing one of the same name
+        :return the QualificationTypeId
+        """
+        try:
+            response = self.amt.client.create_qualification_type(
+                Name=name,
+                Description=description,
+                Keywords=keywords,
+                QualificationTypeStatus='Active',
+            )
+            return response['QualificationType']['QualificationTypeId']
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            # a duplicate name is reported as a generic RequestError, only its message tells it apart
+            if error.get('Code') != 'RequestError' or 'already created a QualificationType' not in error.get('Message', ''):
+                print(e)
+                raise
+            existing = self.amt.client.list_qualification_types(Query=name, MustBeRequestable=False,
+                                                                 MustBeOwnedByCaller=True, MaxResults=100)
+            for qualification_type in existing['QualificationTypes']:
+                if qualification_type['Name'] == name:
+                    return qualification_type['QualificationTypeId']
+            print(e)
+            raise
+
+    def refresh_qualification_grants(self, qualification_type_id):
+        """
+        replaces the local grant cache for a qualification type with the workers currently holding it
+        """
+        paginator = self.amt.client.get_paginator('list_workers_with_qualification_type')
+        workers = {}
+        for r in paginator.paginate(QualificationTypeId=qualification_type_id, Status='Granted',
+                                    PaginationConfig={'PageSize': 100}):
+            for qualification in r['Qualifications']:
+                workers[qualification['WorkerId']] = qualification.get('IntegerValue')
+        self.grants.replace(qualification_type_id, workers)
+        return workers
+
+    def refresh_worker_blocks(self):
+        paginator = self.amt.client.get_paginator('list_worker_blocks')
+        workers = {}
+        for r in paginator.paginate(PaginationConfig={'PageSize': 100}):
+            for block in r['WorkerBlocks']:
+                workers[block['WorkerId']] = True
+        self.grants.replace(WorkerGrantCache.blocks, workers)
+        return workers
+
+    def _run_worker_operation(self, operation, worker_ids, rate, **params):
+        worker_ids = list(worker_ids)
+        limiter = RateLimiter(rate)
+        worker_batches = [worker_ids[i::self.n_threads] for i in range(self.n_threads)]
+        threads = [WorkerOperation(operation, batch, limiter, params, **self.kwargs)
+                   for batch in worker_batches if batch]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        succeeded = [worker_id for thread in threads for worker_id in thread.succeeded]
+        failed = {worker_id: error for thread in threads for worker_id, error in thread.failed.items()}
+        for worker_id, error in failed.items():
+            print(f'{operation} failed for worker {worker_id}: {error}')
+        return succeeded, failed
+
+    def grant_qualification(self, qualification_type_id, worker_ids, value=1, notify=False, rate=10):
+        """
+        grants a custom qualification to the workers that don't already have it with this value
+        :param rate max requests per second across all threads
+        :return list of workers the qualification was granted to
+        """
+        cached = self.grants.get(qualification_type_id)
+        pending = [worker_id for worker_id in set(worker_ids) if cached.get(worker_id) != value]
+        succeeded, _ = self._run_worker_operation('associate_qualification_with_worker', pending, rate,
+                                                  QualificationTypeId=qualification_type_id, IntegerValue=value,
+                                                  SendNotification=notify)
+        self.grants.update(qualification_type_id, {worker_id: value for worker_id in succeeded})
+        return succeeded
+
+    def revoke_qualification(self, qualification_type_id, worker_ids, reason='', rate=10):
+        cached = self.grants.get(qualification_type_id)
+        pending = [worker_id for worker_id in set(worker_ids) if worker_id in cached]
+        succeeded, _ = self._run_worker_operation('disassociate_qualification_from_worker', pending, rate,
+                                                  QualificationTypeId=qualification_type_id, Reason=reason)
+        self.grants.remove(qualification_type_id, succeeded)
+        return succeeded
+
+    def sync_qualification(self, qualification_type_id, worker_ids, value=1, rate=10, refresh=True):
+        """
+        makes worker_ids exactly the set of workers holding the qualification, sending only the differences
+        :param refresh reload the current holders from mturk first, otherwise the differences are computed
+        against the local grant cache and miss grants made outside of it
+        :return (granted, revoked) worker lists
+        """
+        worker_ids = set(worker_ids)
+        if refresh:
+            self.refresh_qualification_grants(qualification_type_id)
+        granted = self.grant_qualification(qualification_type_id, worker_ids, value=value, rate=rate)
+        stale = set(self.grants.get(qualification_type_id)) - worker_ids
+        revoked = self.revoke_qualification(qualification_type_id, stale, rate=rate)
+        return granted, revoked
+
+    def block_workers(self, worker_ids, reason, rate=10):
+        cached = self.grants.get(WorkerGrantCache.blocks)
+        pending = [worker_id for worker_id in set(worker_ids) if worker_id not in cached]
+        succeeded, _ = self._run_worker_operation('create_worker_block', pending, rate, Reason=reason)
+        self.grants.update(WorkerGrantCache.blocks, {worker_id: True for worker_id in succeeded})
+        return succeeded
+
+    def set_notification_settings(self, hit_type_id, destination, event_types=('AssignmentSubmitted', 'HITReviewable'),
+                                  transport='SQS', active=True):
+        """
+        configures mturk to push events for a HIT type instead of having to poll for them
+        :param hit_type_id the HIT type to receive notifications for
+        :param destination the SQS queue url (or SNS topic arn / email address)
+        :param event_types the mturk event types to be notified about
+        :param transport one of SQS, SNS or Email
+        :param active whether notifications are enabled for the HIT type
+        """
+        notification = {
+            'Destination': destination,
+            'Transport': transport,
+            'Version': NOTIFICATION_VERSION,
+            'EventTypes': list(event_types),
+        }
+        try:
+            return self.amt.client.update_notification_settings(HITTypeId=hit_type_id, Notification=notification,
+                                                                Active=active)
+        except ClientError as e:
+            print(e)
+            raise
+
+    def send_test_notification(self, destination, event_type='AssignmentSubmitted', transport='SQS'):
+        notification = {
+            'Destination': destination,
+            'Transport': transport,
+            'Version': NOTIFICATION_VERSION,
+            'EventTypes': [event_type],
+        }
+        return self.amt.client.send_test_event_notification(Notification=notification, TestEventType=event_type)
+
+    def sqs_client(self, queue_url):
+        """
+        :return an sqs client for the region of the queue, for use with notifications.NotificationConsumer
+        """
+        region = queue_url.split('://', 1)[-1].split('.')[1]
+        return self.amt.session.client('sqs', region_name=region, **self.amt.credentials)
+
+    def get_notified_assignments(self, consumer):
+        """
+        fetches only the assignments a NotificationConsumer has seen submitted since the last call
+        :param consumer a notifications.NotificationConsumer
+        :return list of list_assignments_for_hit style responses, suitable for approve_assignments.
+                assignments that couldn't be fetched are handed back to the consumer for the next call
+        """
+        assignments = []
+        for hit_id, assignment_ids in consumer.pop_submitted().items():
+            hit_assignments = []
+            failed = []
+            for assignment_id in assignment_ids:
+                try:
+                    response = self.amt.client.get_assignment(AssignmentId=assignment_id)
+                    hit_assignments.append(response['Assignment'])
+                except ClientError as e:
+                    print(e)
+                    failed.append(assignment_id)
+            if failed:
+                consumer.requeue_submitted(hit_id, failed)
+            assignments.append({'HITId': hit_id, 'Assignments': hit_assignments})
+        return assignments
+
+
+@lru_cache(maxsize=None)
+def _template_environment(template_dir):
+    # jinja caches compiled templates per environment, so reuse one environment per template directory
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
+
+
+def get_template(template_file, template_dir='hit_templates'):
+    """
+    loads a HIT template through the shared environment of its directory, so each template is only compiled once
+    """
+    return _template_environment(template_dir).get_template(template_file)
+
+
+def _unwrap_hits(hits):
+    """
+    accepts HIT dicts / HITRecords as well as create_hit responses, e.g. a HITGroup
+    """
+    return [hit['HIT'] if isinstance(hit, dict) and 'HIT' in hit else hit for hit in hits]
+
+
+def _phase(profiler, name):
+    return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
+
+def _item(profiler, name, label):
+    return profiler.item(name, label) if profiler is not None else contextlib.nullcontext()
+
+
+def annotation_filter(annotations, hit):
+    """
+    checks whether a HIT matches a set of annotations, either exactly or by the batch tag
+    create_hit_group puts in front of the input key. HITs created without an annotation
+    have no RequesterAnnotation field and never match
+    """
+    if annotations is None:
+        return True
+    annotation = hit.get('RequesterAnnotation')
+    if annotation in annotations:
+        return True
+    batch_tag, _ = HITGroup.parse_annotation(annotation)
+    return batch_tag is not None and batch_tag in annotations
+
+
+def iter_reviewable_hits(client, hit_type_id=None, status='Reviewable', annotations=None, projection=None):
+    paginator = client.get_paginator('list_reviewable_hits')
+    query = {'Status': status, 'PaginationConfig': {'PageSize': 100}}
+    if hit_type_id:
+        query['HITTypeId'] = hit_type_id
+    for r in paginator.paginate(**query):
+        for hit in r['HITs']:
+            if annotation_filter(annotations, hit):
+                yield projection(hit) if projection else hit
 
 
 class BotoThreadedOperation(threading.Thread):
 
     def __init__(self, **kwargs):
         self.amt = MturkClient(**kwargs)
+        self.profiler = kwargs.get('profiler')
         super().__init__()
 
+    def _phase(self, name):
+        return _phase(self.profiler, name)
+
+
+class RateLimiter:
+    """
+    token bucket shared by worker threads to keep bulk calls under a request rate
+    """
+
+    def __init__(self, rate):
+        self.interval = 1. / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(self._next, now)
+            self._next = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+class WorkerGrantCache:
+    """
+    local record of the qualifications granted to and blocks placed on workers, so bulk updates only
+    send what changed. kept in memory, and in cache_file if given
+    """
+    blocks = '__worker_blocks__'
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.grants = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.grants = json.load(f)
+        self._lock = threading.Lock()
+
+    def get(self, qualification_type_id):
+        with self._lock:
+            return dict(self.grants.get(qualification_type_id, {}))
+
+    def replace(self, qualification_type_id, workers):
+        with self._lock:
+            self.grants[qualification_type_id] = dict(workers)
+        self.save()
+
+    def update(self, qualification_type_id, workers):
+        with self._lock:
+            self.grants.setdefault(qualification_type_id, {}).update(workers)
+        self.save()
+
+    def remove(self, qualification_type_id, worker_ids):
+        with self._lock:
+            cached = self.grants.setdefault(qualification_type_id, {})
+            for worker_id in worker_ids:
+                cached.pop(worker_id, None)
+        self.save()
+
+    def save(self):
+        if self.cache_file:
+            with self._lock:
+                with open(self.cache_file, 'w') as f:
+                    json.dump(self.grants, f)
+
 
 class ExpireHits(BotoThreadedOperation):
     def __init__(self, hits, **kwargs):
@@ -344,8 +899,78 @@ class ExpireHits(BotoThreadedOperation):
         self.exp_date = datetime.datetime(2001, 1, 1)
 
     def run(self):
-        responses = [self.amt.client.update_expiration_for_hit(HITId=h['HITId'], ExpireAt=self.exp_date)
-                     for h in self.hits]
+        for h in self.hits:
+            with self._phase('update_expiration_for_hit'):
+                self.amt.client.update_expiration_for_hit(HITId=h['HITId'], ExpireAt=self.exp_date)
+
+
+class ListReviewableHits(BotoThreadedOperation):
+    def __init__(self, hit_type_ids, status, annotations=None, fields=None, **kwargs):
+        super().__init__(**kwargs)
+        self.hit_type_ids = hit_type_ids
+        self.status = status
+        self.annotations = annotations
+        self.projection = HITProjection(fields) if fields else None
+        self.hits = []
+        self.failed = {}
+
+    def run(self):
+        for hit_type_id in self.hit_type_ids:
+            try:
+                with self._phase('list_reviewable_hits'):
+                    self.hits.extend(list(iter_reviewable_hits(self.amt.client, hit_type_id, self.status,
+                                                               self.annotations, self.projection)))
+            except ClientError as e:
+                self.failed[hit_type_id] = e
+
+
+class GetHits(BotoThreadedOperation):
+    def __init__(self, hit_ids, fields=None, **kwargs):
+        super().__init__(**kwargs)
+        self.hit_ids = hit_ids
+        self.projection = HITProjection(fields) if fields else None
+        self.hits = []
+
+    def run(self):
+        for hit_id in self.hit_ids:
+            try:
+                with self._phase('get_hit'):
+                    hit = self.amt.client.get_hit(HITId=hit_id)['HIT']
+            except ClientError as e:
+                print(e)
+                continue
+            self.hits.append(self.projection(hit) if self.projection else hit)
+
+
+class WorkerOperation(BotoThreadedOperation):
+    retryable_errors = ('ThrottlingException', 'ServiceUnavailable', 'ServiceFault')
+
+    def __init__(self, operation, worker_ids, limiter, params, max_retries=3, **kwargs):
+        super().__init__(**kwargs)
+        self.operation = operation
+        self.worker_ids = worker_ids
+        self.limiter = limiter
+        self.params = params
+        self.max_retries = max_retries
+        self.succeeded = []
+        self.failed = {}
+
+    def run(self):
+        call = getattr(self.amt.client, self.operation)
+        for worker_id in self.worker_ids:
+            for attempt in range(self.max_retries + 1):
+                self.limiter.wait()
+                try:
+                    with self._phase(self.operation):
+                        call(WorkerId=worker_id, **self.params)
+                    self.succeeded.append(worker_id)
+                    break
+                except ClientError as e:
+                    if e.response['Error']['Code'] in self.retryable_errors and attempt < self.max_retries:
+                        time.sleep(2 ** attempt)
+                        continue
+                    self.failed[worker_id] = e
+                    break
 
 
 class CreateHits(BotoThreadedOperation):
@@ -354,11 +979,197 @@ class CreateHits(BotoThreadedOperation):
         self.batch = batch
         self._queue = target_queue
 
+    def _create_hit(self, point):
+        try:
+            return self.amt.client.create_hit(**point), None
+        except ClientError as e:
+            print(e)
+            return None, e
+
     def run(self):
-        responses = [self.amt.create_hit(**point) for point in self.batch]
+        responses = []
+        for position, point in self.batch:
+            with _item(self.profiler, 'create_hit', position):
+                response, error = self._create_hit(point)
+            responses.append((position, response, error))
         self._queue.put(responses)
 
 
+class HITParamTemplate(Mapping):
+    """
+    read-only create_hit parameters shared by every HIT of a batch. overlay combines them with the
+    per-HIT fields into a new shallow dict, so nothing batch-wide is copied or rebuilt per HIT.
+    as a mapping it reads like the basic_hit_params it was built from, frame_height included, so
+    dict(template) gives params that can be changed and built into a new template
+    """
+    __slots__ = ('params', 'frame_height')
+
+    def __init__(self, basic_hit_params, qualification_requirements):
+        params = dict(basic_hit_params)
+        self.frame_height = params.pop('frame_height')
+        params['QualificationRequirements'] = tuple(qualification_requirements)
+        self.params = MappingProxyType(params)
+
+    def __getitem__(self, key):
+        if key == 'frame_height':
+            return self.frame_height
+        return self.params[key]
+
+    def __iter__(self):
+        yield from self.params
+        yield 'frame_height'
+
+    def __len__(self):
+        return len(self.params) + 1
+
+    def overlay(self, **per_hit_params):
+        hit_params = dict(self.params)
+        hit_params.update(per_hit_params)
+        return hit_params
+
+
+class HITProjection:
+    """
+    builds HITRecords keeping a fixed set of fields; the field layout is shared by all records it builds
+    """
+    default_fields = ('HITId', 'HITTypeId', 'HITGroupId', 'Title', 'CreationTime', 'Expiration', 'HITStatus',
+                      'HITReviewStatus', 'MaxAssignments', 'NumberOfAssignmentsPending',
+                      'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsCompleted', 'RequesterAnnotation')
+    interned_fields = frozenset(['HITTypeId', 'HITGroupId', 'Title', 'Description', 'Keywords', 'HITStatus',
+                                 'HITReviewStatus', 'RequesterAnnotation', 'HITLayoutId'])
+
+    def __init__(self, fields=default_fields):
+        self.fields = tuple(fields)
+        self.positions = {field: i for i, field in enumerate(self.fields)}
+        self._interned = tuple(field in self.interned_fields for field in self.fields)
+
+    def __call__(self, hit):
+        values = []
+        for field, intern in zip(self.fields, self._interned):
+            value = hit.get(field)
+            if intern and isinstance(value, str):
+                value = sys.intern(value)
+            values.append(value)
+        return HITRecord(self, tuple(values))
+
+
+class HITRecord:
+    """
+    compact read-only stand-in for a list_hits HIT dict, supports hit['HITId'] and hit.get(...)
+    """
+    __slots__ = ('_projection', '_values')
+
+    def __init__(self, projection, values):
+        self._projection = projection
+        self._values = values
+
+    def __getitem__(self, field):
+        return self._values[self._projection.positions[field]]
+
+    def __contains__(self, field):
+        return field in self._projection.positions
+
+    def __repr__(self):
+        return f'HITRecord({self.to_dict()})'
+
+    def get(self, field, default=None):
+        position = self._projection.positions.get(field)
+        return default if position is None else self._values[position]
+
+    def keys(self):
+        return self._projection.fields
+
+    def to_dict(self):
+        return dict(zip(self._projection.fields, self._values))
+
+
 class HITGroup:
-    pass
+    """
+    the HITs created for a batch of data points, keyed by each data point's input key. iterating yields the
+    create_hit responses of the HITs that were created, in input order, and integer indexes and slices read
+    that same sequence, like the list create_hit_group used to return. HITs, assignments and HIT ids map
+    back to their input key and data point in O(1)
+    """
+    separator = '|'
+
+    def __init__(self, batch_tag=None):
+        self.batch_tag = batch_tag
+        self.data = {}
+        self.hits = {}
+        self.failures = {}
+        self.hit_keys = {}
+
+    @classmethod
+    def annotation(cls, batch_tag, input_key):
+        if cls.separator in (batch_tag or '') or cls.separator in input_key:
+            raise ValueError(f'batch tag {batch_tag!r} and input key {input_key!r} may not contain {cls.separator!r}')
+        annotation = f'{batch_tag}{cls.separator}{input_key}' if batch_tag else f'{cls.separator}{input_key}'
+        if len(annotation) > 255:
+            raise ValueError(f'RequesterAnnotation {annotation!r} is longer than 255 characters')
+        return annotation
+
+    @classmethod
+    def parse_annotation(cls, annotation):
+        """
+        :return (batch tag, input key). annotations not written by annotation(), i.e. without exactly one
+                separator, are returned whole as the batch tag with no input key
+        """
+        if not annotation or annotation.count(cls.separator) != 1:
+            return annotation or None, None
+        batch_tag, input_key = annotation.split(cls.separator)
+        return batch_tag or None, input_key
+
+    @classmethod
+    def from_hits(cls, hits, batch_tag=None):
+        """
+        rebuilds the HIT id index of a batch from a HIT listing, e.g. get_all_hits(annotations=[batch_tag])
+        """
+        group = cls(batch_tag)
+        for hit in hits:
+            _, input_key = cls.parse_annotation(hit.get('RequesterAnnotation'))
+            if input_key is not None:
+                group.add(input_key, {'HIT': hit})
+        return group
+
+    def add(self, input_key, response=None, error=None):
+        if response is None:
+            self.failures[input_key] = error
+            return
+        self.failures.pop(input_key, None)
+        self.hits[input_key] = response
+        self.hit_keys[response['HIT']['HITId']] = input_key
+
+    def __len__(self):
+        return len(self.hits)
+
+    def __iter__(self):
+        return iter(self.hits.values())
+
+    def __getitem__(self, item):
+        """
+        :param item an input key, or an int / slice into the created HITs in input order
+        """
+        if isinstance(item, (int, slice)):
+            return list(self.hits.values())[item]
+        return self.hits[item]
+
+    def __contains__(self, input_key):
+        return input_key in self.hits
+
+    def key_for(self, item):
+        """
+        :param item a HITId, or a HIT / assignment / create_hit response dict
+        :return the input key of the data point the item belongs to
+        """
+        if isinstance(item, str):
+            return self.hit_keys[item]
+        if 'HIT' in item:
+            item = item['HIT']
+        return self.hit_keys[item['HITId']]
+
+    def data_point(self, item):
+        return self.data[self.key_for(item)]
+
+    def hit_id(self, input_key):
+        return self.hits[input_key]['HIT']['HITId']
 
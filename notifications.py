@@ -0,0 +1,188 @@
+import json
+import queue
+import threading
+import itertools
+from collections import defaultdict
+
+
+# version of the NotificationSpecification sent to the mturk api
+NOTIFICATION_VERSION = '2006-05-05'
+# EventDocVersion of the messages mturk delivers to the queue
+EVENT_DOC_VERSION = '2014-08-15'
+REVIEW_EVENT_TYPES = ['AssignmentSubmitted', 'HITReviewable']
+
+
+class LocalNotificationQueue:
+    """
+    in-memory stand-in for an SQS queue. implements the subset of the boto3 sqs client
+    used by NotificationConsumer so the consumer can be exercised without AWS
+    """
+
+    def __init__(self):
+        self._messages = queue.Queue()
+        self._in_flight = {}
+        self._receipts = itertools.count()
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl=None, MessageBody=''):
+        self._messages.put(MessageBody)
+        return {'MessageId': str(self._messages.qsize())}
+
+    def send_event(self, event_type, hit_id, assignment_id=None, hit_type_id=None, timestamp=None):
+        """
+        enqueues a message shaped like the ones mturk delivers for a single event
+        """
+        event = {
+            'EventType': event_type,
+            'EventTimestamp': timestamp,
+            'HITId': hit_id,
+            'HITTypeId': hit_type_id,
+        }
+        if assignment_id:
+            event['AssignmentId'] = assignment_id
+        body = {'Events': [event], 'EventDocVersion': EVENT_DOC_VERSION}
+        return self.send_message(MessageBody=json.dumps(body))
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=10, WaitTimeSeconds=0, **kwargs):
+        messages = []
+        try:
+            body = self._messages.get(timeout=WaitTimeSeconds) if WaitTimeSeconds else self._messages.get_nowait()
+        except queue.Empty:
+            return {'Messages': []}
+        while True:
+            with self._lock:
+                receipt = str(next(self._receipts))
+                self._in_flight[receipt] = body
+            messages.append({'ReceiptHandle': receipt, 'Body': body})
+            if len(messages) >= MaxNumberOfMessages:
+                break
+            try:
+                body = self._messages.get_nowait()
+            except queue.Empty:
+                break
+        return {'Messages': messages}
+
+    def delete_message(self, QueueUrl=None, ReceiptHandle=None):
+        with self._lock:
+            self._in_flight.pop(ReceiptHandle, None)
+
+
+class NotificationConsumer(threading.Thread):
+    """
+    drains mturk event notifications from an SQS (or LocalNotificationQueue) queue,
+    tracks submitted assignments and reviewable HITs, and dispatches each event to the
+    handlers registered for its type
+    """
+
+    def __init__(self, queue_client, queue_url=None, handlers=None, wait_time=20, max_backoff=300):
+        """
+        :param queue_client a boto3 sqs client or a LocalNotificationQueue
+        :param queue_url the url of the queue the notifications are delivered to
+        :param handlers optional dict of event type -> list of callables taking the event dict
+        :param wait_time long polling wait in seconds for each receive call
+        :param max_backoff cap in seconds on the wait between polls after consecutive errors
+        """
+        super().__init__(daemon=True)
+        self.queue_client = queue_client
+        self.queue_url = queue_url
+        self.wait_time = wait_time
+        self.max_backoff = max_backoff
+        self.n_errors = 0
+        self.last_error = None
+        self.handlers = defaultdict(list)
+        for event_type, callbacks in (handlers or {}).items():
+            self.handlers[event_type].extend(callbacks)
+        self.submitted = defaultdict(set)
+        self.reviewable = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def register(self, event_type, handler):
+        self.handlers[event_type].append(handler)
+
+    def handle_event(self, event):
+        event_type = event.get('EventType')
+        hit_id = event.get('HITId')
+        with self._lock:
+            if event_type == 'AssignmentSubmitted':
+                self.submitted[hit_id].add(event.get('AssignmentId'))
+            elif event_type == 'HITReviewable':
+                self.reviewable.add(hit_id)
+        for handler in self.handlers[event_type]:
+            try:
+                handler(event)
+            except Exception as e:
+                print(e)
+
+    def process_message(self, body):
+        message = json.loads(body)
+        events = message.get('Events', [])
+        for event in events:
+            self.handle_event(event)
+        return events
+
+    def poll_once(self, wait_time=None):
+        """
+        receives and processes a single batch of messages
+        :return the number of messages received
+        """
+        wait_time = self.wait_time if wait_time is None else wait_time
+        response = self.queue_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                                     WaitTimeSeconds=wait_time)
+        messages = response.get('Messages', [])
+        for message in messages:
+            try:
+                self.process_message(message['Body'])
+            except ValueError as e:
+                print(e)
+            self.queue_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+        return len(messages)
+
+    def drain(self):
+        """
+        processes messages until the queue is empty
+        :return the number of messages received
+        """
+        n_messages = 0
+        while True:
+            received = self.poll_once(wait_time=0)
+            if not received:
+                return n_messages
+            n_messages += received
+
+    def pop_submitted(self):
+        """
+        :return dict of HITId -> assignment ids submitted since the last call
+        """
+        with self._lock:
+            submitted, self.submitted = self.submitted, defaultdict(set)
+        return dict(submitted)
+
+    def requeue_submitted(self, hit_id, assignment_ids):
+        """
+        puts back assignment ids taken with pop_submitted that couldn't be processed, so the next call returns them
+        """
+        with self._lock:
+            self.submitted[hit_id].update(assignment_ids)
+
+    def pop_reviewable(self):
+        with self._lock:
+            reviewable, self.reviewable = self.reviewable, set()
+        return reviewable
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        backoff = 1
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+                backoff = 1
+            except Exception as e:
+                # keep consuming through transient endpoint / throttling errors, see n_errors and last_error
+                self.n_errors += 1
+                self.last_error = e
+                print(f'notification poll failed, retrying in {backoff}s: {e}')
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,152 @@
+import os
+import time
+import heapq
+import cProfile
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PhaseProfiler:
+    """
+    records wall time, CPU time and net allocated memory per named phase and per thread, and optionally
+    keeps cProfile stats for the slowest individual items (e.g. single create_hit calls).
+    memory is measured with tracemalloc, which is process wide, so allocations of phases running
+    concurrently on other threads are attributed to whichever phase is open at the time.
+    """
+
+    def __init__(self, trace_memory=True, profile_dir=None, n_slowest=5):
+        """
+        :param trace_memory start tracemalloc (if not already tracing) to record allocations, stopped again by close
+        :param profile_dir directory to dump cProfile stats of the slowest items to, None to disable
+        :param n_slowest how many item profiles to keep
+        """
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.n_slowest = n_slowest
+        self.stats = defaultdict(lambda: {'calls': 0, 'wall': 0., 'cpu': 0., 'alloc': 0})
+        self._slowest = []
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def close(self):
+        """
+        stops tracemalloc if this profiler started it, tracing slows down every allocation in the process
+        """
+        if self._started_tracing:
+            self._started_tracing = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def _record(self, name, wall, cpu, alloc):
+        with self._lock:
+            stats = self.stats[(name, threading.current_thread().name)]
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            stats['alloc'] += alloc
+
+    @contextmanager
+    def phase(self, name):
+        traced = self.trace_memory and tracemalloc.is_tracing()
+        mem_start = tracemalloc.get_traced_memory()[0] if traced else 0
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            alloc = tracemalloc.get_traced_memory()[0] - mem_start if traced else 0
+            self._record(name, wall, cpu, alloc)
+
+    @contextmanager
+    def item(self, name, label):
+        """
+        like phase, and also profiles the item with cProfile if profile_dir is set
+        :param label identifies the item in the dumped file name, e.g. its position in the batch
+        """
+        if self.profile_dir is None:
+            with self.phase(name):
+                yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active on this thread
+            profile = None
+        wall_start = time.perf_counter()
+        try:
+            with self.phase(name):
+                yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                wall = time.perf_counter() - wall_start
+                with self._lock:
+                    self._counter += 1
+                    entry = (wall, self._counter, f'{name}_{label}', profile)
+                    if len(self._slowest) < self.n_slowest:
+                        heapq.heappush(self._slowest, entry)
+                    else:
+                        heapq.heappushpop(self._slowest, entry)
+
+    def phase_totals(self):
+        """
+        :return dict of phase -> stats summed over threads
+        """
+        totals = defaultdict(lambda: {'calls': 0, 'wall': 0., 'cpu': 0., 'alloc': 0, 'threads': 0})
+        with self._lock:
+            for (name, _), stats in self.stats.items():
+                total = totals[name]
+                for field in ('calls', 'wall', 'cpu', 'alloc'):
+                    total[field] += stats[field]
+                total['threads'] += 1
+        return dict(totals)
+
+    def summary(self):
+        lines = [f'{"phase":<28}{"calls":>8}{"threads":>9}{"wall s":>10}{"cpu s":>10}{"alloc MB":>10}']
+        totals = sorted(self.phase_totals().items(), key=lambda item: -item[1]['wall'])
+        for name, stats in totals:
+            lines.append(f'{name:<28}{stats["calls"]:>8}{stats["threads"]:>9}{stats["wall"]:>10.3f}'
+                         f'{stats["cpu"]:>10.3f}{stats["alloc"] / 2 ** 20:>10.2f}')
+        lines.append('')
+        lines.append(f'{"phase":<28}{"thread":<20}{"calls":>8}{"wall s":>10}{"cpu s":>10}')
+        with self._lock:
+            per_thread = sorted(self.stats.items())
+        for (name, thread_name), stats in per_thread:
+            lines.append(f'{name:<28}{thread_name:<20}{stats["calls"]:>8}{stats["wall"]:>10.3f}{stats["cpu"]:>10.3f}')
+        return '\n'.join(lines)
+
+    def dump_slowest(self):
+        """
+        writes the kept item profiles to profile_dir, loadable with pstats
+        :return the written file names, slowest first
+        """
+        if self.profile_dir is None:
+            return []
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        files = []
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        for rank, (wall, _, label, profile) in enumerate(slowest):
+            profile_file = os.path.join(self.profile_dir, f'{rank:02d}_{label}_{wall:.3f}s.prof')
+            profile.dump_stats(profile_file)
+            files.append(profile_file)
+        return files
+
+    def report(self):
+        """
+        prints the summary, dumps the slowest item profiles and closes the profiler
+        """
+        print(self.summary())
+        for profile_file in self.dump_slowest():
+            print(f'wrote {profile_file}')
+        self.close()
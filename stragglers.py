@@ -0,0 +1,172 @@
+import time
+import datetime
+from botocore.exceptions import ClientError
+
+
+REPUBLISHED_FIELDS = ('Title', 'Description', 'Keywords', 'Reward', 'AssignmentDurationInSeconds',
+                      'AutoApprovalDelayInSeconds', 'QualificationRequirements', 'Question', 'RequesterAnnotation')
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+class StragglerMonitor:
+    """
+    follows a batch of HITs, measures how long completed HITs took and how fast the batch is completing,
+    and treats incomplete HITs much older than the typical completion time as stragglers. stragglers are
+    mitigated by extending their expiration, or by expiring them and republishing their remaining
+    assignments with a higher reward (and optionally changed HIT type fields).
+    """
+
+    def __init__(self, mturk, hit_ids, quantile=0.9, factor=2., min_age=3600,
+                 min_completed_fraction=0.5, mitigation='republish', extend_by=86400, reward_multiplier=1.25,
+                 hit_type_params=None, lifetime=259200, max_republish=2):
+        """
+        :param mturk an MTurk instance
+        :param hit_ids the HITs of the batch
+        :param quantile completion time quantile stragglers are measured against
+        :param factor a HIT is a straggler once older than factor times that quantile
+        :param min_age never treat HITs younger than this many seconds as stragglers
+        :param min_completed_fraction fraction of the batch that must be complete before judging stragglers
+        :param mitigation 'extend' or 'republish'
+        :param extend_by seconds to push the expiration out by when extending
+        :param reward_multiplier reward increase for republished HITs
+        :param hit_type_params optional Title/Description/Keywords overrides, republishing under a new HIT type
+        :param lifetime LifetimeInSeconds for republished HITs
+        :param max_republish how many times a single data point may be republished
+        """
+        self.mturk = mturk
+        self.quantile = quantile
+        self.factor = factor
+        self.min_age = min_age
+        self.min_completed_fraction = min_completed_fraction
+        self.mitigation = mitigation
+        self.extend_by = extend_by
+        self.reward_multiplier = reward_multiplier
+        self.hit_type_params = hit_type_params or {}
+        self.lifetime = lifetime
+        self.max_republish = max_republish
+        self.hits = {hit_id: None for hit_id in hit_ids}
+        self.completed_at = {}
+        self.republished = {}
+        self.generation = {hit_id: 0 for hit_id in hit_ids}
+        self.mitigated = set()
+
+    def poll(self):
+        """
+        refreshes the state of the monitored HITs that are still outstanding, fetching them by id
+        """
+        outstanding = [hit_id for hit_id, hit in self.hits.items()
+                       if hit_id not in self.republished and (hit is None or not self.is_complete(hit))]
+        for hit in self.mturk.get_hits(outstanding, fields=('HITId', 'CreationTime', 'HITStatus', 'MaxAssignments',
+                                                            'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsPending',
+                                                            'NumberOfAssignmentsCompleted', 'RequesterAnnotation')):
+            self.hits[hit['HITId']] = hit
+            if self.is_complete(hit) and hit['HITId'] not in self.completed_at:
+                self.completed_at[hit['HITId']] = _now()
+
+    @staticmethod
+    def is_complete(hit):
+        """
+        a HIT is done once every assignment is submitted. NumberOfAssignmentsCompleted only counts approved
+        or rejected assignments, so it lags behind by the review / auto approval delay and isn't used here
+        """
+        if hit['HITStatus'] in ('Reviewable', 'Reviewing'):
+            return True
+        return not hit['NumberOfAssignmentsAvailable'] and not hit['NumberOfAssignmentsPending']
+
+    def active_hits(self):
+        return [hit for hit_id, hit in self.hits.items()
+                if hit is not None and hit_id not in self.republished and not self.is_complete(hit)]
+
+    def completion_durations(self):
+        return [(completed - self.hits[hit_id]['CreationTime']).total_seconds()
+                for hit_id, completed in self.completed_at.items()]
+
+    def velocity(self, window=3600):
+        """
+        :return HITs completed per hour over the last window seconds
+        """
+        since = _now() - datetime.timedelta(seconds=window)
+        return sum(1 for completed in self.completed_at.values() if completed >= since) * 3600. / window
+
+    def stragglers(self):
+        durations = self.completion_durations()
+        n_tracked = sum(1 for hit_id in self.hits if hit_id not in self.republished)
+        if not durations or len(durations) < self.min_completed_fraction * n_tracked:
+            return []
+        threshold = max(self.min_age, self.factor * _quantile(durations, self.quantile))
+        now = _now()
+        return [hit for hit in self.active_hits()
+                if hit['HITId'] not in self.mitigated and (now - hit['CreationTime']).total_seconds() > threshold]
+
+    def extend(self, hit):
+        self.mturk.amt.client.update_expiration_for_hit(
+            HITId=hit['HITId'],
+            ExpireAt=_now() + datetime.timedelta(seconds=self.extend_by))
+        self.mitigated.add(hit['HITId'])
+
+    def republish(self, hit):
+        """
+        creates a replacement for the HIT's unassigned assignments, then expires the HIT. if creating the
+        replacement fails the original is left running
+        :return the replacement HITId, or None
+        """
+        hit_id = hit['HITId']
+        if self.generation[hit_id] >= self.max_republish or not hit['NumberOfAssignmentsAvailable']:
+            self.extend(hit)
+            return None
+        full_hit = self.mturk.amt.client.get_hit(HITId=hit_id)['HIT']
+        params = {field: full_hit[field] for field in REPUBLISHED_FIELDS if field in full_hit}
+        params.update(self.hit_type_params)
+        params['Reward'] = f'{float(full_hit["Reward"]) * self.reward_multiplier:.2f}'
+        params['MaxAssignments'] = hit['NumberOfAssignmentsAvailable']
+        params['LifetimeInSeconds'] = self.lifetime
+        response = self.mturk.amt.create_hit(**params)
+        if response is None:
+            return None
+        new_hit_id = response['HIT']['HITId']
+        self.republished[hit_id] = new_hit_id
+        self.hits[new_hit_id] = None
+        self.generation[new_hit_id] = self.generation[hit_id] + 1
+        self.mturk.amt.client.update_expiration_for_hit(HITId=hit_id, ExpireAt=datetime.datetime(2001, 1, 1))
+        return new_hit_id
+
+    def mitigate(self):
+        """
+        applies the configured mitigation to the current stragglers
+        :return dict of straggling HITId -> replacement HITId (or None if it was extended)
+        """
+        actions = {}
+        for hit in self.stragglers():
+            try:
+                if self.mitigation == 'republish':
+                    actions[hit['HITId']] = self.republish(hit)
+                else:
+                    self.extend(hit)
+                    actions[hit['HITId']] = None
+            except ClientError as e:
+                print(e)
+        return actions
+
+    def run(self, interval=600, timeout=None):
+        """
+        polls and mitigates until every monitored HIT is complete or replaced
+        :param interval seconds between polls
+        :param timeout optional seconds to give up after
+        """
+        started = time.time()
+        while True:
+            self.poll()
+            actions = self.mitigate()
+            remaining = len(self.active_hits()) + sum(1 for hit in self.hits.values() if hit is None)
+            print(f'{remaining} HITs outstanding, {self.velocity():.1f} completed/hour, {len(actions)} mitigated')
+            if not remaining or (timeout is not None and time.time() - started > timeout):
+                return self.republished
+            time.sleep(interval)
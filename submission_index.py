@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import datetime
+
+
+def _stable_json(value):
+    """
+    json form of values json can't encode natively that is the same in every run. sets are sorted
+    since their iteration order depends on hash randomization
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=lambda item: json.dumps(item, sort_keys=True, default=_stable_json))
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} render parameter has no stable json form for the content key')
+
+
+def content_key(template_params, render_params):
+    """
+    stable hash of a task template and the parameters it is rendered with
+    :param template_params dict with template_dir and template_file
+    :param render_params the template kwargs for one data point, json serializable (sets and datetimes allowed)
+    :return hex digest
+    """
+    payload = json.dumps({
+        'template': [template_params.get('template_dir'), template_params.get('template_file')],
+        'params': render_params,
+    }, sort_keys=True, default=_stable_json)
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class SubmissionIndex:
+    """
+    persistent map from content key (see content_key) to the HIT created for it, used to skip data points
+    earlier batches already submitted. stored as an append-only json lines file.
+    """
+
+    def __init__(self, index_file='submission_index.jsonl'):
+        self.index_file = index_file
+        self.hit_ids = {}
+        self.keys = {}
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.hit_ids[entry['key']] = entry['hit_id']
+                    self.keys[entry['hit_id']] = entry['key']
+
+    def __len__(self):
+        return len(self.hit_ids)
+
+    def __contains__(self, key):
+        return key in self.hit_ids
+
+    content_key = staticmethod(content_key)
+
+    def add(self, pairs):
+        """
+        :param pairs iterable of (content key, HITId)
+        """
+        with open(self.index_file, 'a') as f:
+            for key, hit_id in pairs:
+                self.hit_ids[key] = hit_id
+                self.keys[hit_id] = key
+                f.write(json.dumps({'key': key, 'hit_id': hit_id}) + '\n')
+
+    def hit_for_key(self, key):
+        return self.hit_ids.get(key)
+
+    def key_for_hit(self, hit_id):
+        return self.keys.get(hit_id)